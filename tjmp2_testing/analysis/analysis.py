@@ -10,7 +10,6 @@ import os
 import numba
 import numpy as np
 import tables as tb
-from pixel_clusterizer.clusterizer import HitClusterizer
 from tjmonopix2.analysis import analysis_utils as au
 from tjmonopix2.analysis.interpreter import RawDataInterpreter
 from tjmonopix2.analysis.events import build_events
@@ -18,6 +17,61 @@ from tjmonopix2.system import logger
 from tqdm import tqdm
 
 
+# End of cluster function to calculate cluster shape and cluster distance
+# in column and row direction; on module level to cache the compilation
+@numba.njit(cache=True)
+def _end_of_cluster_function(hits, clusters, cluster_size,
+                             cluster_hit_indices, cluster_index,
+                             cluster_id, charge_correction,
+                             noisy_pixels, disabled_pixels,
+                             seed_hit_index):
+    hit_arr = np.zeros((15, 15), dtype=np.bool_)
+    center_col = hits[cluster_hit_indices[0]].column
+    center_row = hits[cluster_hit_indices[0]].row
+    hit_arr[7, 7] = 1
+    min_col = hits[cluster_hit_indices[0]].column
+    max_col = hits[cluster_hit_indices[0]].column
+    min_row = hits[cluster_hit_indices[0]].row
+    max_row = hits[cluster_hit_indices[0]].row
+    for i in cluster_hit_indices[1:]:
+        if i < 0:  # Not used indeces = -1
+            break
+        diff_col = np.int32(hits[i].column - center_col)
+        diff_row = np.int32(hits[i].row - center_row)
+        if np.abs(diff_col) < 8 and np.abs(diff_row) < 8:
+            hit_arr[7 + hits[i].column - center_col,
+                    7 + hits[i].row - center_row] = 1
+        if hits[i].column < min_col:
+            min_col = hits[i].column
+        if hits[i].column > max_col:
+            max_col = hits[i].column
+        if hits[i].row < min_row:
+            min_row = hits[i].row
+        if hits[i].row > max_row:
+            max_row = hits[i].row
+
+    if max_col - min_col < 8 and max_row - min_row < 8:
+        # Make 8x8 array
+        col_base = 7 + min_col - center_col
+        row_base = 7 + min_row - center_row
+        cluster_arr = hit_arr[col_base:col_base + 8,
+                              row_base:row_base + 8]
+        # Finally calculate cluster shape
+        # uint64 desired, but numexpr and others limited to int64
+        if cluster_arr[7, 7] == 1:
+            cluster_shape = np.int64(-1)
+        else:
+            cluster_shape = np.int64(
+                au.calc_cluster_shape(cluster_arr))
+    else:
+        # Cluster is exceeding 8x8 array
+        cluster_shape = np.int64(-1)
+
+    clusters[cluster_index].cluster_shape = cluster_shape
+    clusters[cluster_index].dist_col = max_col - min_col + 1
+    clusters[cluster_index].dist_row = max_row - min_row + 1
+
+
 class Analysis(object):
     def __init__(self, raw_data_file=None, analyzed_data_file=None, tot_calib_file=None,
                  store_hits=True, cluster_hits=False, analyze_tdc=False, use_tdc_trigger_dist=False,
@@ -190,59 +244,7 @@ class Analysis(object):
         self.cluster_dtype = np.dtype(cluster_description)
 
         if self.cluster_hits:  # Allow analysis without clusterizer installed
-            # Define end of cluster function to calculate cluster shape
-            # and cluster distance in column and row direction
-            @numba.njit
-            def _end_of_cluster_function(hits, clusters, cluster_size,
-                                         cluster_hit_indices, cluster_index,
-                                         cluster_id, charge_correction,
-                                         noisy_pixels, disabled_pixels,
-                                         seed_hit_index):
-                hit_arr = np.zeros((15, 15), dtype=np.bool_)
-                center_col = hits[cluster_hit_indices[0]].column
-                center_row = hits[cluster_hit_indices[0]].row
-                hit_arr[7, 7] = 1
-                min_col = hits[cluster_hit_indices[0]].column
-                max_col = hits[cluster_hit_indices[0]].column
-                min_row = hits[cluster_hit_indices[0]].row
-                max_row = hits[cluster_hit_indices[0]].row
-                for i in cluster_hit_indices[1:]:
-                    if i < 0:  # Not used indeces = -1
-                        break
-                    diff_col = np.int32(hits[i].column - center_col)
-                    diff_row = np.int32(hits[i].row - center_row)
-                    if np.abs(diff_col) < 8 and np.abs(diff_row) < 8:
-                        hit_arr[7 + hits[i].column - center_col,
-                                7 + hits[i].row - center_row] = 1
-                    if hits[i].column < min_col:
-                        min_col = hits[i].column
-                    if hits[i].column > max_col:
-                        max_col = hits[i].column
-                    if hits[i].row < min_row:
-                        min_row = hits[i].row
-                    if hits[i].row > max_row:
-                        max_row = hits[i].row
-
-                if max_col - min_col < 8 and max_row - min_row < 8:
-                    # Make 8x8 array
-                    col_base = 7 + min_col - center_col
-                    row_base = 7 + min_row - center_row
-                    cluster_arr = hit_arr[col_base:col_base + 8,
-                                          row_base:row_base + 8]
-                    # Finally calculate cluster shape
-                    # uint64 desired, but numexpr and others limited to int64
-                    if cluster_arr[7, 7] == 1:
-                        cluster_shape = np.int64(-1)
-                    else:
-                        cluster_shape = np.int64(
-                            au.calc_cluster_shape(cluster_arr))
-                else:
-                    # Cluster is exceeding 8x8 array
-                    cluster_shape = np.int64(-1)
-
-                clusters[cluster_index].cluster_shape = cluster_shape
-                clusters[cluster_index].dist_col = max_col - min_col + 1
-                clusters[cluster_index].dist_row = max_row - min_row + 1
+            from pixel_clusterizer.clusterizer import HitClusterizer
 
             def end_of_cluster_function(hits, clusters, cluster_size,
                                         cluster_hit_indices, cluster_index,
@@ -13,12 +13,22 @@ from functools import partial
 
 import numba
 import numpy as np
-from scipy.optimize import OptimizeWarning, curve_fit
-from scipy.special import erf
+import tables as tb
 from tqdm import tqdm
 
 logger = logging.getLogger('Analysis')
 
+FIT_PROCESSES = None  # processes of the pixel fit pools, all cores if None
+
+# Compression for raw data files
+FILTER_RAW_DATA = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
+# Selectable raw data compression: cheap during capture, small for archiving
+COMPRESSION_PROFILES = {
+    'fast': tb.Filters(complib='blosc:lz4', complevel=1, fletcher32=False),
+    'balanced': FILTER_RAW_DATA,
+    'archival': tb.Filters(complib='blosc:zstd', complevel=9, shuffle=False, bitshuffle=True, fletcher32=False)
+}
+
 hit_dtype = np.dtype([
     ("col", "<i2"),
     ("row", "<i2"),
@@ -82,16 +92,18 @@ def _tot_response_func(x, a, b, d):
     return (a / x + 1 / b) * (x - d)
 
 
-@numba.njit
+@numba.njit(cache=True)
 def _inv_tot_response_func(tot, a, b, d):
     return (np.sqrt(b**2 * (a - tot)**2 + 2 * b * d * (a + tot) + d**2) - b * a + b * tot + d) * 0.5
 
 
 def scurve(x, A, mu, sigma):
+    from scipy.special import erf  # scipy is imported on first use, it is slow to import
     return 0.5 * A * erf((x - mu) / (np.sqrt(2) * sigma)) + 0.5 * A
 
 
 def zcurve(x, A, mu, sigma):
+    from scipy.special import erf
     return -0.5 * A * erf((x - mu) / (np.sqrt(2) * sigma)) + 0.5 * A
 
 
@@ -102,7 +114,7 @@ def gauss(x, A, mu, sigma):
 def imap_bar(func, args, n_processes=None, unit='it', unit_scale=False):
     ''' Apply function (func) to interable (args) with progressbar
     '''
-    p = mp.Pool(n_processes)
+    p = mp.Pool(n_processes or FIT_PROCESSES)
     res_list = []
     pbar = tqdm(total=len(args), unit=unit, unit_scale=unit_scale)
     for _, res in enumerate(p.imap(func, args)):
@@ -114,7 +126,7 @@ def imap_bar(func, args, n_processes=None, unit='it', unit_scale=False):
     return res_list
 
 
-@numba.njit(locals={'cluster_shape': numba.int64})
+@numba.njit(locals={'cluster_shape': numba.int64}, cache=True)
 def calc_cluster_shape(cluster_array):
     '''Boolean 8x8 array to number.
     '''
@@ -125,7 +137,7 @@ def calc_cluster_shape(cluster_array):
     return cluster_shape
 
 
-@numba.njit(numba.int64(numba.uint32, numba.uint32))
+@numba.njit(numba.int64(numba.uint32, numba.uint32), cache=True)
 def xy2d_morton(x, y):
     ''' Tuple to number.
 
@@ -184,8 +196,10 @@ def get_noise(x, y, n_injections):
     mu = get_threshold(x, y, n_injections)
     d = np.abs(np.diff(x)[0])
 
-    mu1 = y[x < mu].sum()
-    mu2 = (n_injections - y[x > mu]).sum()
+    # Compare along last dimension to support 1D and 2D hists
+    mu = np.asarray(mu)[..., np.newaxis]
+    mu1 = np.where(x < mu, y, 0).sum(axis=-1)
+    mu2 = np.where(x > mu, n_injections - y, 0).sum(axis=-1)
 
     return d * (mu1 + mu2).astype(float) / n_injections * np.sqrt(np.pi / 2.)
 
@@ -246,6 +260,7 @@ def fit_scurve(scurve_data, scan_params, n_injections, sigma_0):
         idx = np.ravel(np.where(np.logical_and(y != 0, y != n_injections)))[0]
         p0 = (x[idx], 0.1 * np.min(np.diff(x)))
 
+    from scipy.optimize import OptimizeWarning, curve_fit
     try:
         with warnings.catch_warnings():
             warnings.simplefilter("ignore", OptimizeWarning)
@@ -473,6 +488,7 @@ def _fit_tot_response(data, scan_params):
 
     p0 = [40, 0.005, 0.1]
 
+    from scipy.optimize import OptimizeWarning, curve_fit
     try:
         with warnings.catch_warnings():
             warnings.simplefilter("ignore", OptimizeWarning)
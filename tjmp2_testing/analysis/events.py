@@ -6,7 +6,7 @@ from tqdm import tqdm
 from tjmonopix2.analysis import analysis_utils as au
 
 
-@njit
+@njit(cache=True)
 def build_events(hits, buffer, trigger_n=0, trigger_ts=0, event_n=0):
     """Build events from interpreted hits (including TLU words). Corrects trigger timestamp overflow
        and searches for hit words within fixed timeframe after trigger word.
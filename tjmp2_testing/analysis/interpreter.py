@@ -23,32 +23,32 @@ class_spec = [
 ]
 
 
-@numba.njit
+@numba.njit(cache=True)
 def is_tjmono(word):
     return (word & 0xF8000000) == 0x40000000
 
 
-@numba.njit
+@numba.njit(cache=True)
 def is_tlu(word):
     return word & 0x80000000 == 0x80000000
 
 
-@numba.njit
+@numba.njit(cache=True)
 def is_tdc(word):
     return word & 0xF0000000 == 0x20000000
 
 
-@numba.njit
+@numba.njit(cache=True)
 def is_tjmono_timestamp_msb(word):
     return (word & 0xFC000000) == 0x4C000000
 
 
-@numba.njit
+@numba.njit(cache=True)
 def is_tjmono_timestamp_lsb(word):
     return (word & 0xFC000000) == 0x48000000
 
 
-@numba.njit
+@numba.njit(cache=True)
 def get_tlu_word(word, trigger_data_format):
     if trigger_data_format == 2:
         return word & 0xFFFF, (word >> 16) & 0x7FFF
@@ -58,11 +58,42 @@ def get_tlu_word(word, trigger_data_format):
         return word & 0x7FFFFFFF, 0
 
 
-@numba.njit
+@numba.njit(cache=True)
 def get_tdc_value(word):
     return word & 0xFFF
 
 
+@numba.njit(cache=True)
+def get_tjmono_symbols(word):
+    ''' Split a 32-bit TJ-Monopix2 FPGA word into its three 9-bit symbols, first symbol first '''
+    return (word & 0x7FC0000) >> 18, (word & 0x003FE00) >> 9, word & 0x00001FF
+
+
+@numba.njit(cache=True)
+def split_tjmono_symbols(raw_data):
+    ''' 9-bit symbol stream of all TJ-Monopix2 words in raw_data '''
+    symbols = np.empty(3 * len(raw_data), dtype=np.uint16)
+    n_symbols = 0
+    for word in raw_data:
+        if is_tjmono(word):
+            for d in get_tjmono_symbols(word):
+                symbols[n_symbols] = d
+                n_symbols += 1
+    return symbols[:n_symbols]
+
+
+@numba.njit(cache=True)
+def gray2bin(gray):
+    b6 = gray & 0x40
+    b5 = (gray & 0x20) ^ (b6 >> 1)
+    b4 = (gray & 0x10) ^ (b5 >> 1)
+    b3 = (gray & 0x08) ^ (b4 >> 1)
+    b2 = (gray & 0x04) ^ (b3 >> 1)
+    b1 = (gray & 0x02) ^ (b2 >> 1)
+    b0 = (gray & 0x01) ^ (b1 >> 1)
+    return b6 + b5 + b4 + b3 + b2 + b1 + b0
+
+
 @numba.experimental.jitclass(class_spec)
 class RawDataInterpreter(object):
     def __init__(self, n_scan_params=1, trigger_data_format=1):
@@ -92,12 +123,7 @@ class RawDataInterpreter(object):
             elif is_tjmono_timestamp_lsb(raw_data_word):
                 self.tj_timestamp = self.tj_timestamp | (raw_data_word & 0x3FFFFFF)
             elif is_tjmono(raw_data_word):
-                dat = np.zeros(3, dtype=np.uint16)
-                dat[0] = (raw_data_word & 0x7FC0000) >> 18
-                dat[1] = (raw_data_word & 0x003FE00) >> 9
-                dat[2] = (raw_data_word & 0x00001FF)
-
-                for d in dat:
+                for d in get_tjmono_symbols(raw_data_word):
                     if d == 0x1bc:  # SOF hit data
                         if self.sof:
                             self.error_cnt += 1  # SOF before EOF
@@ -120,11 +146,11 @@ class RawDataInterpreter(object):
                             self.col = (d & 0xFF) << 1
                         elif self.tj_data_flag == 1:
                             self.tj_data_flag = 2
-                            self.le = self._gray2bin((d & 0xfe) >> 1)
+                            self.le = gray2bin((d & 0xfe) >> 1)
                             self.te = (d & 0x01) << 6
                         elif self.tj_data_flag == 2:
                             self.tj_data_flag = 3
-                            self.te = self._gray2bin(self.te | ((d & 0xfc) >> 2))
+                            self.te = gray2bin(self.te | ((d & 0xfc) >> 2))
                             self.row = (d & 0x01) << 8
                             self.col = self.col + ((d & 0x02) >> 1)
                         elif self.tj_data_flag == 3:
@@ -207,16 +233,6 @@ class RawDataInterpreter(object):
     def get_error_count(self):
         return self.error_cnt
 
-    def _gray2bin(self, gray):
-        b6 = gray & 0x40
-        b5 = (gray & 0x20) ^ (b6 >> 1)
-        b4 = (gray & 0x10) ^ (b5 >> 1)
-        b3 = (gray & 0x08) ^ (b4 >> 1)
-        b2 = (gray & 0x04) ^ (b3 >> 1)
-        b1 = (gray & 0x02) ^ (b2 >> 1)
-        b0 = (gray & 0x01) ^ (b1 >> 1)
-        return b6 + b5 + b4 + b3 + b2 + b1 + b0
-
     def _fill_hist(self, col, row, tot, scan_param_id):
         self.hist_occ[col, row, scan_param_id] += 1
         self.hist_tot[col, row, scan_param_id, tot] += 1
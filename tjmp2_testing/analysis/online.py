@@ -15,28 +15,17 @@ import multiprocessing
 import time
 import queue
 from functools import reduce
+from operator import mul
 
 import numpy as np
 import numba
 
 from tjmonopix2.analysis import analysis_utils as au
-from tjmonopix2.analysis.interpreter import is_tjmono
+from tjmonopix2.analysis.interpreter import get_tjmono_symbols, gray2bin, is_tjmono
 
 logger = logging.getLogger('OnlineAnalysis')
 
 
-@numba.njit(cache=True, fastmath=True)
-def gray2bin(gray):
-    b6 = gray & 0x40
-    b5 = (gray & 0x20) ^ (b6 >> 1)
-    b4 = (gray & 0x10) ^ (b5 >> 1)
-    b3 = (gray & 0x08) ^ (b4 >> 1)
-    b2 = (gray & 0x04) ^ (b3 >> 1)
-    b1 = (gray & 0x02) ^ (b2 >> 1)
-    b0 = (gray & 0x01) ^ (b1 >> 1)
-    return b6 + b5 + b4 + b3 + b2 + b1 + b0
-
-
 @numba.njit(cache=True, fastmath=True)
 def histogram(raw_data, occ_hist, hit_data, is_sof, is_eof, tj_data_flag):
     ''' Raw data to 2D occupancy histogram '''
@@ -45,13 +34,7 @@ def histogram(raw_data, occ_hist, hit_data, is_sof, is_eof, tj_data_flag):
         if not is_tjmono(word):
             continue
 
-        # Split 32bit FPGA word into single data words
-        dat = np.zeros(3, dtype=np.uint16)
-        dat[0] = (word & 0x7FC0000) >> 18
-        dat[1] = (word & 0x003FE00) >> 9
-        dat[2] = (word & 0x00001FF)
-
-        for d in dat:
+        for d in get_tjmono_symbols(word):  # split 32bit FPGA word into single data words
             if d == 0x1bc:
                 is_sof = 1
                 tj_data_flag = 0
@@ -83,10 +66,68 @@ def histogram(raw_data, occ_hist, hit_data, is_sof, is_eof, tj_data_flag):
     return hit_data, is_sof, is_eof, tj_data_flag
 
 
+@numba.njit(cache=True, fastmath=True)
+def histogram_hits(raw_data, scan_param_id, occ_hist, tot_hist, tot_sum_hist, occ_param_hist, hit_data, is_sof, is_eof, tj_data_flag):
+    ''' Raw data to several hit histograms in one pass
+
+        Histograms with a length of zero are not filled.
+    '''
+    fill_occ = occ_hist.shape[0] > 0
+    fill_tot = tot_hist.shape[0] > 0
+    fill_tot_sum = tot_sum_hist.shape[0] > 0
+    fill_occ_param = occ_param_hist.shape[0] > 0 and scan_param_id < occ_param_hist.shape[2]
+
+    for word in raw_data:
+        if not is_tjmono(word):
+            continue
+
+        for d in get_tjmono_symbols(word):  # split 32bit FPGA word into single data words
+            if d == 0x1bc:
+                is_sof = 1
+                tj_data_flag = 0
+            elif d == 0x17c:
+                is_eof = 1
+            elif d == 0x13c:
+                pass
+            else:
+                if tj_data_flag == 0:
+                    tj_data_flag = 1
+                    hit_data[0]['col'] = (d & 0xff) << 1
+                elif tj_data_flag == 1:
+                    tj_data_flag = 2
+                    hit_data[0]['le'] = gray2bin((d & 0xfe) >> 1)
+                    hit_data[0]['te'] = (d & 0x01) << 6
+                elif tj_data_flag == 2:
+                    tj_data_flag = 3
+                    hit_data[0]['te'] = gray2bin(hit_data[0]['te'] | ((d & 0xfc) >> 2))
+                    hit_data[0]['row'] = (d & 0x01) << 8
+                    hit_data[0]['col'] = hit_data[0]['col'] + ((d & 0x02) >> 1)
+                elif tj_data_flag == 3:
+                    tj_data_flag = 0
+                    hit_data[0]['row'] = hit_data[0]['row'] | (d & 0xff)
+
+                    # Hit is complete, add to histograms
+                    col = hit_data[0]['col']
+                    row = hit_data[0]['row']
+                    if col < 512 and row < 512:
+                        tot = (hit_data[0]['te'] - hit_data[0]['le']) & 0x7F
+                        if fill_occ:
+                            occ_hist[col, row] += 1
+                        if fill_tot:
+                            tot_hist[tot] += 1
+                        if fill_tot_sum:
+                            tot_sum_hist[col, row] += tot
+                        if fill_occ_param:
+                            occ_param_hist[col, row, scan_param_id] += 1
+
+    return hit_data, is_sof, is_eof, tj_data_flag
+
+
 class OnlineHistogrammingBase():
     ''' Base class to do online analysis with raw data from chip.
 
-        The output data is a histogram of a given shape.
+        The output data is a histogram of a given shape or, if the shape is a dict,
+        several named histograms of the given shapes.
     '''
     _queue_timeout = 0.01  # max blocking time to delete object [s]
 
@@ -100,18 +141,37 @@ class OnlineHistogrammingBase():
         self.p = None  # process
 
     def init(self):
-        # Create shared memory 32 bit unsigned int numpy array
-        n_values = reduce(lambda x, y: x * y, self.shape)
-        shared_array_base = multiprocessing.Array(ctypes.c_uint, n_values)
-        shared_array = np.ctypeslib.as_array(shared_array_base.get_obj())
-        self.hist = shared_array.reshape(*self.shape)
+        # Create two shared memory 32 bit unsigned int numpy arrays (double buffering).
+        # The worker fills the active one, get() swaps them and hands out the filled one.
+        shapes = self.shape.values() if isinstance(self.shape, dict) else [self.shape]
+        n_values = sum(reduce(mul, shape, 1) for shape in shapes)
+        self._shared_array_bases = [multiprocessing.Array(ctypes.c_uint, n_values, lock=False) for _ in range(2)]
+        self._active = multiprocessing.Value(ctypes.c_int, 0, lock=False)  # index of buffer filled by worker, guarded by self.lock
+        self._buffers = [np.ctypeslib.as_array(base) for base in self._shared_array_bases]
+        self._hists = [self._get_views(buffer) for buffer in self._buffers]
         self.idle_worker = multiprocessing.Event()
         self.p = multiprocessing.Process(target=self.worker,
-                                         args=(self._raw_data_queue, shared_array_base,
+                                         args=(self._raw_data_queue, self._shared_array_bases, self._active,
                                                self.lock, self.stop, self.idle_worker))
         self.p.start()
         logger.info('Starting process %d', self.p.pid)
 
+    def _get_views(self, buffer):
+        ''' Split flat buffer into histogram(s) of the requested shape(s) '''
+        if not isinstance(self.shape, dict):
+            return buffer.reshape(self.shape)
+        views, offset = {}, 0
+        for name, shape in self.shape.items():
+            n_values = reduce(mul, shape, 1)
+            views[name] = buffer[offset:offset + n_values].reshape(shape)
+            offset += n_values
+        return views
+
+    @property
+    def hist(self):
+        ''' Histogram that is currently filled by the worker '''
+        return self._hists[self._active.value]
+
     def analysis_function(self, raw_data, hist, *args):
         raise NotImplementedError("You have to implement the analysis_funtion")
 
@@ -126,10 +186,18 @@ class OnlineHistogrammingBase():
 
     def _reset_hist(self):
         with self.lock:
-            self.hist = self.hist.reshape(-1)
-            for i in range(self.hist.shape[0]):
-                self.hist[i] = 0
-            self.hist = self.hist.reshape(self.shape)
+            for buffer in self._buffers:
+                buffer.fill(0)
+
+    def _swap_hist(self):
+        ''' Let the worker continue on the zeroed buffer and return the filled one '''
+        with self.lock:
+            buffer = self._buffers[self._active.value]
+            self._active.value ^= 1
+        # The worker does not access the filled buffer anymore, thus no lock needed
+        result = buffer.copy()
+        buffer.fill(0)
+        return self._get_views(result)
 
     def reset(self, wait=True, timeout=0.5):
         ''' Reset histogram '''
@@ -143,6 +211,13 @@ class OnlineHistogrammingBase():
 
     def get(self, wait=True, timeout=None, reset=True):
         ''' Get the result histogram '''
+        self._wait_for_worker(wait, timeout)
+        if reset:
+            return self._swap_hist()
+        else:
+            return self.hist
+
+    def _wait_for_worker(self, wait, timeout):
         if not wait:
             if not self._raw_data_queue.empty() or not self.idle_worker.is_set():
                 logger.warning('Getting histogram while analyzing data')
@@ -150,23 +225,15 @@ class OnlineHistogrammingBase():
             if not self.idle_worker.wait(timeout):
                 logger.warning('Getting histogram while analyzing data. Consider increasing the timeout.')
 
-        if reset:
-            hist = self.hist.copy()
-            # No overwrite with a new zero array due to shared memory
-            self._reset_hist()
-            return hist
-        else:
-            return self.hist
-
-    def worker(self, raw_data_queue, shared_array_base, lock, stop, idle):
+    def worker(self, raw_data_queue, shared_array_bases, active, lock, stop, idle):
         ''' Histogramming in seperate process '''
-        hist = np.ctypeslib.as_array(shared_array_base.get_obj()).reshape(self.shape)
+        hists = [self._get_views(np.ctypeslib.as_array(base)) for base in shared_array_bases]
         while not stop.is_set():
             try:
                 data = raw_data_queue.get(timeout=self._queue_timeout)
                 idle.clear()
                 with lock:
-                    return_values = self.analysis_function(data, hist, **self.analysis_function_kwargs)
+                    return_values = self.analysis_function(data, hists[active.value], **self.analysis_function_kwargs)
                     self.analysis_function_kwargs.update(zip(self.analysis_function_kwargs, return_values))
             except queue.Empty:
                 idle.set()
@@ -206,3 +273,150 @@ class OccupancyHistogramming(OnlineHistogrammingBase):
         setattr(OccupancyHistogramming, 'analysis_function', analysis_function)
 
         self.init()
+
+
+class HitHistogramming(OnlineHistogrammingBase):
+    ''' Fast histogramming of raw data to several hit histograms at once
+
+        The raw data is decoded only once and all requested outputs are filled from the same hit stream:
+            occupancy: 2D hit histogram (col, row)
+            tot: ToT spectrum of all pixels
+            tot_sum: sum of ToT values per pixel (col, row), divide by occupancy to get the mean ToT
+            occupancy_per_param: 2D hit histogram per scan parameter id (col, row, scan_param_id)
+
+        get() returns a dict with the requested histograms. If several chips are histogrammed
+        by one worker (n_chips > 1) every histogram has an additional first axis for the chip index.
+        No event building.
+    '''
+    outputs = ('occupancy', 'tot', 'tot_sum', 'occupancy_per_param')
+
+    def __init__(self, outputs=('occupancy', 'tot'), n_scan_params=1, n_chips=1):
+        unknown = set(outputs) - set(self.outputs)
+        if unknown:
+            raise ValueError('Unknown online histogram(s): %s' % ', '.join(sorted(unknown)))
+        shapes = {'occupancy': (512, 512),
+                  'tot': (128, ),
+                  'tot_sum': (512, 512),
+                  'occupancy_per_param': (512, 512, n_scan_params)}
+        if n_chips > 1:
+            shapes = {name: (n_chips, ) + shape for name, shape in shapes.items()}
+        super().__init__(shape={name: shapes[name] for name in self.outputs if name in outputs})
+        self.n_scan_params = n_scan_params
+        self.n_chips = n_chips
+        # Decoder state per chip
+        self.analysis_function_kwargs = {'hit_data': np.zeros(n_chips, dtype=au.hit_dtype),
+                                         'is_sof': np.full(n_chips, -1, dtype=np.int64),
+                                         'is_eof': np.full(n_chips, -1, dtype=np.int64),
+                                         'tj_data_flag': np.zeros(n_chips, dtype=np.int64)}
+        self.init()
+
+    def add(self, raw_data, scan_param_id=0, chip_index=0):
+        ''' Add raw data of given scan parameter id and chip to be histogrammed '''
+        super().add(raw_data, meta_data=(scan_param_id, chip_index))
+
+    def get_chip(self, chip_index, wait=True, timeout=None, reset=True):
+        ''' Get the result histograms of one chip
+
+            Other chips histogrammed by the same worker are not affected.
+        '''
+        if self.n_chips == 1:
+            return self.get(wait=wait, timeout=timeout, reset=reset)
+        self._wait_for_worker(wait, timeout)
+        with self.lock:
+            hists = self.hist
+            result = {name: hist[chip_index].copy() for name, hist in hists.items()}
+            if reset:  # The inactive buffer is never filled, resetting the active one is sufficient
+                for hist in hists.values():
+                    hist[chip_index].fill(0)
+        return result
+
+    def analysis_function(self, data, hists, hit_data, is_sof, is_eof, tj_data_flag):
+        raw_data, (scan_param_id, chip_index) = data
+        if self.n_chips > 1:
+            hists = {name: hist[chip_index] for name, hist in hists.items()}
+        _, is_sof[chip_index], is_eof[chip_index], tj_data_flag[chip_index] = histogram_hits(
+            raw_data, scan_param_id,
+            hists.get('occupancy', np.zeros((0, 0), dtype=np.uint32)),
+            hists.get('tot', np.zeros((0, ), dtype=np.uint32)),
+            hists.get('tot_sum', np.zeros((0, 0), dtype=np.uint32)),
+            hists.get('occupancy_per_param', np.zeros((0, 0, 0), dtype=np.uint32)),
+            hit_data[chip_index:chip_index + 1], is_sof[chip_index], is_eof[chip_index], tj_data_flag[chip_index])
+        return hit_data, is_sof, is_eof, tj_data_flag
+
+
+class SCurveHistogramming(HitHistogramming):
+    ''' Online threshold and noise estimation during a threshold scan
+
+        Hits are histogrammed per pixel and scan parameter id. Threshold and noise maps are
+        calculated from the scan parameters histogrammed so far using the fit-less
+        approximations of analysis_utils.get_threshold and analysis_utils.get_noise.
+    '''
+
+    def __init__(self, scan_params, n_injections):
+        super().__init__(outputs=('occupancy_per_param', ), n_scan_params=len(scan_params))
+        self.scan_params = np.asarray(scan_params, dtype=float)
+        self.n_injections = n_injections
+
+    def get_maps(self, n_scan_params=None, wait=True, timeout=None):
+        ''' Threshold and noise map from the first n_scan_params scan parameter ids
+
+            Pixels without hits are set to NaN. The histogram is not reset.
+        '''
+        if n_scan_params is None:
+            n_scan_params = self.n_scan_params
+        threshold_map = np.full((512, 512), np.nan)
+        noise_map = np.full((512, 512), np.nan)
+        if n_scan_params < 2:  # Approximations need at least two scan parameters
+            return threshold_map, noise_map
+
+        occ = self.get(wait=wait, timeout=timeout, reset=False)['occupancy_per_param'][:, :, :n_scan_params]
+        sel = occ.any(axis=2)
+        x = self.scan_params[:n_scan_params]
+        y = occ[sel].astype(float)
+        threshold_map[sel] = au.get_threshold(x=x, y=y, n_injections=self.n_injections)
+        noise_map[sel] = au.get_noise(x=x, y=y, n_injections=self.n_injections)
+        return threshold_map, noise_map
+
+
+class OnlineHistogrammingPool():
+    ''' Online histogramming of several chips
+
+        The raw data is routed by receiver to HitHistogramming workers. Every chip gets its own
+        worker process as long as CPU cores are available, otherwise several chips share one worker.
+    '''
+
+    def __init__(self, receivers, outputs=('occupancy', ), n_scan_params=1, n_workers=None):
+        receivers = list(dict.fromkeys(receivers))
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count() - 1  # one core is needed for readout
+        n_workers = max(1, min(n_workers, len(receivers)))
+
+        self.workers = []
+        self._routes = {}  # receiver -> (worker, chip index in worker)
+        for i in range(n_workers):
+            group = receivers[i::n_workers]
+            worker = HitHistogramming(outputs=outputs, n_scan_params=n_scan_params, n_chips=len(group))
+            self.workers.append(worker)
+            for chip_index, receiver in enumerate(group):
+                self._routes[receiver] = (worker, chip_index)
+        logger.info('Online histogramming of %d chip(s) in %d process(es)', len(receivers), n_workers)
+
+    def add(self, raw_data, receiver, scan_param_id=0):
+        ''' Add raw data of the chip at receiver to be histogrammed '''
+        worker, chip_index = self._routes[receiver]
+        worker.add(raw_data, scan_param_id=scan_param_id, chip_index=chip_index)
+
+    def get(self, receiver, wait=True, timeout=None, reset=True):
+        ''' Get the result histograms of the chip at receiver '''
+        worker, chip_index = self._routes[receiver]
+        return worker.get_chip(chip_index, wait=wait, timeout=timeout, reset=reset)
+
+    def reset(self, wait=True, timeout=0.5):
+        ''' Reset histograms of all chips '''
+        for worker in self.workers:
+            worker.reset(wait=wait, timeout=timeout)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
@@ -0,0 +1,273 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Re-analysis of many runs in parallel: the raw data files (or interpreted files for plotting
+    only) of directories or glob patterns are analyzed and plotted on a process pool.
+
+        python batch_analysis.py output_data/ --cluster_hits
+
+    Jobs are started as long as their estimated memory fits into the memory budget. Runs whose
+    interpreted file and pdf are newer than the raw data file and the analysis / plotting code are
+    skipped, so after a change of the analysis code only the affected steps are redone. The outputs
+    are written to temporary files and only renamed if the step succeeded, failed runs are redone.
+    The analysis options are stored in the interpreted file, runs analyzed with other options
+    are redone; interpreted files of scans do not have them, use -f to redo these.
+'''
+
+import argparse
+import glob
+import json
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import tables as tb
+from tqdm import tqdm
+
+from tjmonopix2.analysis import analysis_utils as au
+from tjmonopix2.system import logger
+
+log = logger.setup_derived_logger('BatchAnalysis')
+
+ANALYSIS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'analysis')
+ANALYSIS_SOURCES = ('analysis.py', 'analysis_utils.py', 'events.py', 'interpreter.py')  # code the interpreted files depend on
+PLOTTING_SOURCES = ('plotting.py', )  # code the pdf files depend on
+
+BASE_MEMORY = 2 ** 29  # memory of a worker process with imported analysis (numba, scipy, matplotlib)
+
+
+class BatchJob(object):
+    ''' Analysis and / or plotting of one run '''
+
+    def __init__(self, raw_data_file, interpreted_file, steps, memory):
+        self.raw_data_file = raw_data_file
+        self.interpreted_file = interpreted_file
+        self.pdf_file = interpreted_file[:-3] + '.pdf'
+        self.steps = steps  # ('analyze', 'plot') or a subset
+        self.memory = memory  # estimated peak memory in bytes
+
+    def __repr__(self):
+        return '%s (%s)' % (os.path.basename(self.raw_data_file or self.interpreted_file), ', '.join(self.steps))
+
+
+def find_files(patterns):
+    ''' h5 files of directories (recursive) and glob patterns '''
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*.h5')
+        files.update(f for f in glob.glob(pattern, recursive=True) if f.endswith('.h5'))
+    return sorted(files)
+
+
+def _mtime(filename):
+    return os.path.getmtime(filename) if os.path.isfile(filename) else None
+
+
+def _is_up_to_date(output_file, input_files):
+    ''' Output exists and is newer than all inputs '''
+    output_time = _mtime(output_file)
+    return output_time is not None and all(output_time >= _mtime(f) for f in input_files if _mtime(f) is not None)
+
+
+def _get_analysis_options(interpreted_file):
+    ''' Analysis options stored by a batch analysis, None if unknown '''
+    try:
+        with tb.open_file(interpreted_file) as in_file:
+            if 'batch_analysis_options' in in_file.root._v_attrs:
+                return json.loads(in_file.root._v_attrs.batch_analysis_options)
+    except (IOError, tb.HDF5ExtError):
+        pass
+    return None
+
+
+def estimate_memory(raw_data_file=None, interpreted_file=None, steps=('analyze', 'plot'), chunk_size=1000000):
+    '''
+        Peak memory of a job. Dominated by the per scan parameter occupancy and ToT histograms of the
+        interpreter (512 x 512 x (1 + 128) counters), which are copied when stored and fitted.
+    '''
+    memory = BASE_MEMORY
+    if 'analyze' in steps:
+        with tb.open_file(raw_data_file) as in_file:
+            scan_param_ids = in_file.root.meta_data.col('scan_param_id')
+        n_scan_params = int(scan_param_ids.max()) + 1 if len(scan_param_ids) else 1
+        memory += 2 * n_scan_params * 512 * 512 * (4 + 128 * 2)
+        memory += 2 * 4 * chunk_size * au.hit_dtype.itemsize  # hit buffer and hits of the chunk
+    elif 'plot' in steps:
+        try:
+            with tb.open_file(interpreted_file) as in_file:
+                memory += 2 * sum(in_file.get_node(in_file.root, name).size_in_memory for name in ('HistOcc', 'HistTot') if name in in_file.root)
+        except (IOError, tb.HDF5ExtError):  # broken file, the plotting job reports the error
+            pass
+    return memory
+
+
+def get_jobs(files, analyze=True, plot=True, force=False, track_code=True, analysis_kwargs=None):
+    '''
+        Jobs for the raw data and interpreted files. Interpreted files are only plotted, unless their raw data
+        file is given too. Steps with up to date outputs are skipped unless force is set; interpreted files
+        of a batch analysis with other analysis_kwargs are not up to date.
+    '''
+    analysis_kwargs = analysis_kwargs or {}
+    chunk_size = analysis_kwargs.get('chunk_size', 1000000)
+    analysis_sources = [os.path.join(ANALYSIS_DIR, f) for f in ANALYSIS_SOURCES] if track_code else []
+    plotting_sources = [os.path.join(ANALYSIS_DIR, f) for f in PLOTTING_SOURCES] if track_code else []
+    raw_data_files = [f for f in files if not f.endswith('_interpreted.h5')]
+    interpreted_files = [f for f in files if f.endswith('_interpreted.h5') and f[:-15] + '.h5' not in raw_data_files]
+
+    jobs = []
+    for raw_data_file in raw_data_files:
+        try:
+            with tb.open_file(raw_data_file) as in_file:
+                if 'raw_data' not in in_file.root or 'configuration_in' not in in_file.root:
+                    log.debug('Skipping %s: no raw data file', raw_data_file)
+                    continue
+        except (IOError, tb.HDF5ExtError):
+            log.warning('Skipping %s: cannot open file', raw_data_file)
+            continue
+        interpreted_file = raw_data_file[:-3] + '_interpreted.h5'
+        steps = []
+        if analyze and (force or not _is_up_to_date(interpreted_file, [raw_data_file] + analysis_sources) or
+                        _get_analysis_options(interpreted_file) not in (None, analysis_kwargs)):
+            steps.append('analyze')
+        if plot and (force or steps or not _is_up_to_date(interpreted_file[:-3] + '.pdf', [interpreted_file] + plotting_sources)):
+            steps.append('plot')
+        if steps:
+            jobs.append(BatchJob(raw_data_file, interpreted_file, tuple(steps), estimate_memory(raw_data_file, interpreted_file, steps, chunk_size)))
+
+    if plot:
+        for interpreted_file in interpreted_files:
+            if force or not _is_up_to_date(interpreted_file[:-3] + '.pdf', [interpreted_file] + plotting_sources):
+                jobs.append(BatchJob(None, interpreted_file, ('plot', ), estimate_memory(None, interpreted_file, ('plot', ))))
+    return jobs
+
+
+def _init_worker(fit_processes):
+    au.FIT_PROCESSES = fit_processes  # share the cores between the jobs running in parallel
+
+
+def run_job(job, analysis_kwargs):
+    '''
+        Runs the steps of the job in a worker process, returns the job, duration and error (None if successful).
+        The outputs are written to temporary files that replace the outputs only if the step succeeded,
+        so that a failed step is not taken as up to date.
+    '''
+    start = time.time()
+    tmp_files = [job.interpreted_file + '.tmp', job.pdf_file + '.tmp']
+    try:
+        if 'analyze' in job.steps:
+            from tjmonopix2.analysis import analysis
+            with analysis.Analysis(raw_data_file=job.raw_data_file, analyzed_data_file=tmp_files[0], **analysis_kwargs) as a:
+                a.analyze_data()
+            with tb.open_file(tmp_files[0], 'r+') as out_file:
+                out_file.root._v_attrs.batch_analysis_options = json.dumps(analysis_kwargs)
+            os.replace(tmp_files[0], job.interpreted_file)
+        if 'plot' in job.steps:
+            from tjmonopix2.analysis import plotting  # Needs matplotlib
+            with plotting.Plotting(analyzed_data_file=job.interpreted_file, pdf_file=tmp_files[1]) as p:
+                p.create_standard_plots()
+            os.replace(tmp_files[1], job.pdf_file)
+        return job, time.time() - start, None
+    except Exception:
+        return job, time.time() - start, traceback.format_exc()
+    finally:
+        for tmp_file in tmp_files:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+
+def get_available_memory():
+    ''' Available physical memory in bytes '''
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):  # not available on this platform
+        return 2 ** 33
+
+
+def run_batch(jobs, n_workers=None, memory_budget=None, analysis_kwargs=None):
+    '''
+        Runs the jobs on n_workers processes. A job is only started if the estimated memory of the running
+        jobs stays within memory_budget (bytes, 80 % of the available memory if None); a single job is always started.
+
+        Returns the failed jobs with their error.
+    '''
+    n_workers = n_workers or os.cpu_count() or 1
+    memory_budget = memory_budget or 0.8 * get_available_memory()
+    analysis_kwargs = analysis_kwargs or {}
+    log.info('Running %d jobs on %d processes with %1.1f GB memory budget', len(jobs), n_workers, memory_budget / 2 ** 30)
+
+    pending = sorted(jobs, key=lambda job: job.memory, reverse=True)  # start big jobs first, small jobs fill the gaps
+    running = {}  # future -> job
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(max(1, (os.cpu_count() or 1) // n_workers), )) as executor, \
+            tqdm(total=len(jobs), unit=' Jobs') as pbar:
+        while pending or running:
+            used_memory = sum(job.memory for job in running.values())
+            for job in list(pending):
+                if len(running) >= n_workers:
+                    break
+                if running and used_memory + job.memory > memory_budget:
+                    continue
+                if job.memory > memory_budget:
+                    log.warning('Estimated memory of %s (%1.1f GB) exceeds the memory budget', job, job.memory / 2 ** 30)
+                running[executor.submit(run_job, job, analysis_kwargs)] = job
+                used_memory += job.memory
+                pending.remove(job)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                job, duration, error = future.result()
+                if error:
+                    log.error('Failed %s after %1.1f s:\n%s', job, duration, error)
+                    failed.append((job, error))
+                else:
+                    log.debug('Finished %s in %1.1f s', job, duration)
+                pbar.update()
+    return failed
+
+
+def main(patterns, analyze=True, plot=True, force=False, track_code=True, n_workers=None, memory_budget=None, analysis_kwargs=None):
+    analysis_kwargs = analysis_kwargs or {}
+    files = find_files(patterns)
+    jobs = get_jobs(files, analyze=analyze, plot=plot, force=force, track_code=track_code, analysis_kwargs=analysis_kwargs)
+    log.info('Found %d h5 files, %d jobs to run', len(files), len(jobs))
+    if not jobs:
+        return []
+    start = time.time()
+    failed = run_batch(jobs, n_workers=n_workers, memory_budget=memory_budget, analysis_kwargs=analysis_kwargs)
+    if failed:
+        log.error('%d of %d jobs failed: %s', len(failed), len(jobs), ', '.join(str(job) for job, _ in failed))
+    else:
+        log.success('All %d jobs done in %1.1f s', len(jobs), time.time() - start)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyze and plot runs in parallel, skipping up to date outputs')
+    parser.add_argument('files', nargs='+', help='directories, h5 files or glob patterns of raw data or interpreted files')
+    parser.add_argument('--no_analysis', action='store_true', help='only plot existing interpreted files')
+    parser.add_argument('--no_plots', action='store_true', help='do not create the pdf files')
+    parser.add_argument('-f', '--force', action='store_true', help='redo all steps, also if the outputs are up to date (needed if the analysis options of interpreted files of scans change)')
+    parser.add_argument('--ignore_code_changes', action='store_true', help='do not redo steps if only the analysis / plotting code is newer')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of parallel jobs, all cores if not given')
+    parser.add_argument('--memory_gb', type=float, default=None, help='memory budget, 80 %% of the available memory if not given')
+    parser.add_argument('--cluster_hits', action='store_true', help='cluster the hits')
+    parser.add_argument('--build_events', action='store_true', help='build events (TLU triggered runs)')
+    parser.add_argument('--tot_calib_file', default=None, help='ToT calibration for the clusterizer')
+    parser.add_argument('--chunk_size', type=int, default=1000000, help='raw data words analyzed at once')
+    args = parser.parse_args()
+
+    analysis_kwargs = {'cluster_hits': args.cluster_hits or args.tot_calib_file is not None,
+                       'build_events': args.build_events,
+                       'tot_calib_file': args.tot_calib_file,
+                       'chunk_size': args.chunk_size}
+    failed = main(args.files, analyze=not args.no_analysis, plot=not args.no_plots, force=args.force, track_code=not args.ignore_code_changes,
+                  n_workers=args.jobs, memory_budget=args.memory_gb * 2 ** 30 if args.memory_gb else None, analysis_kwargs=analysis_kwargs)
+    if failed:
+        raise SystemExit(1)
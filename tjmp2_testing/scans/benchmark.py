@@ -0,0 +1,271 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Benchmarks of the analysis and chip configuration code. The results are stored as JSON,
+    compare them to the results of another version to see regressions:
+
+        python benchmark.py --output benchmark_new.json --compare benchmark_old.json
+
+    The start up time of a scan and of the analysis (imports, numba compilation) is measured in
+    new processes. Synthetic data from the simulated readout system is used unless a recorded run is given:
+
+        python benchmark.py --raw_data_file output_data/module_0/chip_0/20221106_224756_source_scan.h5
+'''
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numba
+import numpy as np
+import tables as tb
+from scipy.special import erf
+
+from tjmonopix2.analysis import analysis_utils as au
+from tjmonopix2.analysis.events import build_events
+from tjmonopix2.analysis.interpreter import RawDataInterpreter
+from tjmonopix2.system import logger
+from tjmonopix2.system.sim_daq import DEFAULT_SETTINGS, SimChip, SimDaq
+from tjmonopix2.system.tjmonopix2 import TJMonoPix2
+
+log = logger.setup_derived_logger('Benchmark')
+
+
+def run_benchmark(func, n, unit, repeat=3, warmup=True):
+    '''
+        Time func() repeat times, the first call (numba compilation, caches) is timed separately.
+
+        Returns a dict with the rate (n / best time) in unit.
+    '''
+    first_call = None
+    if warmup:
+        start = time.perf_counter()
+        func()
+        first_call = time.perf_counter() - start
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'n': int(n),
+            'unit': unit,
+            'rate': n / min(times),
+            'best': min(times),
+            'median': float(np.median(times)),
+            'first_call': first_call}
+
+
+def get_raw_data(n_words, raw_data_file=None, seed=0):
+    ''' Raw data of a recorded run or synthetic source scan data with TLU words '''
+    if raw_data_file:
+        with tb.open_file(raw_data_file) as in_file:
+            return in_file.root.raw_data[:n_words]
+    chip = SimChip(dict(DEFAULT_SETTINGS, seed=seed))
+    chip.pixels[:] = 4  # all pixels enabled
+    n_particles = n_words // 4  # about 4 words per particle with TLU word
+    return chip.get_random_hits(n_particles=n_particles, triggers=np.arange(n_particles))[:n_words]
+
+
+def get_hit_data(n_hits, seed=0):
+    ''' Interpreted hits of events: TLU word followed by hits within the event building time window '''
+    rng = np.random.default_rng(seed)
+    n_events = n_hits // 3
+    sizes = 1 + rng.poisson(2., size=n_events)  # TLU word and about two hits per event
+    starts = np.cumsum(sizes) - sizes
+    trigger_ts = np.arange(n_events, dtype=np.int64) * 1000
+    hits = np.zeros(sizes.sum(), dtype=au.hit_dtype)
+    hits['col'] = rng.integers(0, 512, size=len(hits))
+    hits['row'] = rng.integers(0, 512, size=len(hits))
+    hits['le'] = rng.integers(0, 64, size=len(hits))
+    hits['te'] = hits['le'] + rng.integers(1, 64, size=len(hits))
+    hits['timestamp'] = np.repeat(trigger_ts, sizes) + rng.integers(101, 450, size=len(hits))
+    hits['col'][starts] = 1023
+    hits['timestamp'][starts] = trigger_ts
+    return hits
+
+
+def bench_interpreter(raw_data, repeat=3):
+    hit_buffer = np.zeros(len(raw_data), dtype=au.hit_dtype)
+    interpreter = RawDataInterpreter(n_scan_params=1, trigger_data_format=0)
+
+    def func():
+        interpreter.interpret(raw_data, hit_buffer, 0)
+
+    return run_benchmark(func, len(raw_data), 'words/s', repeat=repeat)
+
+
+def bench_build_events(hits, repeat=3):
+    def func():
+        build_events(hits.copy(), np.zeros(len(hits), dtype=au.event_dtype), 0, 0, 0)
+
+    return run_benchmark(func, len(hits), 'hits/s', repeat=repeat)
+
+
+def bench_clusterizer(hits, repeat=3):
+    from tjmonopix2.analysis.analysis import Analysis  # Needs pixel_clusterizer
+    ana = Analysis.__new__(Analysis)  # clusterizer setup of the analysis without raw data file
+    ana.cluster_hits = True
+    ana.tot_calib_file = None
+    ana._setup_clusterizer()
+    events, _, _, _ = build_events(hits.copy(), np.zeros(len(hits), dtype=au.event_dtype), 0, 0, 0)
+    result = {}
+
+    def func():
+        result['clusters'] = ana.clz.cluster_hits(events)[1]
+
+    ret = run_benchmark(func, len(events), 'hits/s', repeat=repeat)
+    ret['clusters_per_s'] = len(result['clusters']) / ret['best']
+    return ret
+
+
+def bench_fit_scurves(n_pixels, n_injections=100, seed=0):
+    ''' S-curve fit of the pixel matrix with data in n_pixels '''
+    rng = np.random.default_rng(seed)
+    scan_params = np.arange(0, 50)
+    thr = rng.normal(25, 2, size=(n_pixels, 1))
+    noise = np.abs(rng.normal(1, 0.1, size=(n_pixels, 1)))
+    scurves = np.zeros((512 * 512, len(scan_params)))
+    scurves[:n_pixels] = rng.binomial(n_injections, 0.5 * (1 + erf((scan_params - thr) / (np.sqrt(2) * noise))))
+    ret = run_benchmark(lambda: au.fit_scurves_multithread(scurves, scan_params, n_injections), 512 * 512, 'pixels/s', repeat=1, warmup=False)
+    ret['pixels_with_data'] = n_pixels
+    return ret
+
+
+def bench_fit_tot(n_pixels, seed=0):
+    ''' ToT response fit of the pixel matrix with data in n_pixels '''
+    rng = np.random.default_rng(seed)
+    scan_params = np.arange(20, 60, 2, dtype=float)
+    tot_avg = np.full((512 * 512, len(scan_params)), np.nan)
+    a, b, d = rng.normal(2, 0.1, size=(n_pixels, 1)), rng.normal(0.5, 0.02, size=(n_pixels, 1)), rng.normal(15, 1, size=(n_pixels, 1))
+    tot_avg[:n_pixels] = (a / scan_params + 1 / b) * (scan_params - d) + rng.normal(0, 0.5, size=(n_pixels, len(scan_params)))
+    ret = run_benchmark(lambda: au.fit_tot_response_multithread(tot_avg, scan_params), 512 * 512, 'pixels/s', repeat=1, warmup=False)
+    ret['pixels_with_data'] = n_pixels
+    return ret
+
+
+def bench_mask_update(repeat=3):
+    ''' Write of the full pixel matrix configuration to the simulated readout system '''
+    daq = SimDaq(bench_config={})
+    daq.init()
+    chip = TJMonoPix2(daq)
+    chip.masks['enable'][:] = True
+    chip.masks['injection'][::4, ::4] = True
+    return run_benchmark(lambda: chip.masks.update(force=True), 512 * 512, 'pixels/s', repeat=repeat)
+
+
+STARTUP_TARGETS = {
+    'startup_scan_threshold': 'import tjmonopix2.scans.scan_threshold',
+    'startup_analysis': 'import tjmonopix2.analysis.analysis',
+    'startup_interpreter_jit': 'import numpy as np\n'
+                               'from tjmonopix2.analysis import analysis_utils as au\n'
+                               'from tjmonopix2.analysis.interpreter import RawDataInterpreter\n'
+                               'RawDataInterpreter().interpret(np.zeros(1, dtype=np.uint32), np.zeros(4, dtype=au.hit_dtype), 0)',
+}
+
+
+def bench_startup(code, repeat=3):
+    '''
+        Time of code in a new python process (imports and numba compilation or loading from cache).
+        The first call fills the numba cache and is timed separately.
+    '''
+    script = 'import time\nstart = time.perf_counter()\n' + code + '\nprint(time.perf_counter() - start)'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))  # same packages as this process
+
+    def func():
+        ret = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True)
+        if ret.returncode:
+            raise ImportError(ret.stderr.strip().splitlines()[-1])
+        return float(ret.stdout.strip().splitlines()[-1])
+
+    first_call = func()
+    times = [func() for _ in range(repeat)]
+    return {'n': 1,
+            'unit': 'starts/s',
+            'rate': 1. / min(times),
+            'best': min(times),
+            'median': float(np.median(times)),
+            'first_call': first_call}
+
+
+def get_environment():
+    env = {'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+           'host': platform.node(),
+           'python': platform.python_version(),
+           'numpy': np.__version__,
+           'numba': numba.__version__,
+           'cpu_count': mp.cpu_count()}
+    try:
+        env['git_revision'] = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                                      stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        env['git_revision'] = None
+    return env
+
+
+def compare(results, reference_file):
+    with open(reference_file) as f:
+        reference = json.load(f)['results']
+    for name, result in results.items():
+        if name in reference and 'rate' in reference[name] and 'rate' in result:
+            ratio = result['rate'] / reference[name]['rate']
+            log.info('%-20s %10.3e %-10s (%1.2f x reference)%s', name, result['rate'], result['unit'], ratio, ' <-- regression' if ratio < 0.9 else '')
+
+
+def main(output, raw_data_file=None, n_words=2 ** 22, fit_pixels=4096, skip=(), reference_file=None):
+    benchmarks = {
+        'interpreter': lambda: bench_interpreter(raw_data),
+        'build_events': lambda: bench_build_events(hits),
+        'clusterizer': lambda: bench_clusterizer(hits),
+        'fit_scurves': lambda: bench_fit_scurves(fit_pixels),
+        'fit_tot_response': lambda: bench_fit_tot(fit_pixels),
+        'mask_update': bench_mask_update,
+    }
+    for name, code in STARTUP_TARGETS.items():
+        benchmarks[name] = lambda code=code: bench_startup(code)
+
+    raw_data = get_raw_data(n_words, raw_data_file)
+    hits = get_hit_data(n_words // 4)
+
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if name in skip:
+            continue
+        log.info('Running benchmark %s...', name)
+        try:
+            results[name] = benchmark()
+        except ImportError as e:
+            log.warning('Skipping benchmark %s: %s', name, e)
+            results[name] = {'skipped': str(e)}
+            continue
+        log.info('%-20s %10.3e %s', name, results[name]['rate'], results[name]['unit'])
+
+    with open(output, 'w') as f:
+        json.dump({'environment': get_environment(), 'raw_data_file': raw_data_file, 'results': results}, f, indent=2)
+    log.success('Benchmark results written to %s', output)
+
+    if reference_file:
+        compare(results, reference_file)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark interpreter, event builder, clusterizer, fits, mask writing and start up time')
+    parser.add_argument('--output', default='benchmark.json', help='output JSON file')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous benchmark to compare to')
+    parser.add_argument('--raw_data_file', default=None, help='recorded run to take the raw data from')
+    parser.add_argument('--n_words', type=int, default=2 ** 22, help='number of raw data words')
+    parser.add_argument('--fit_pixels', type=int, default=4096, help='number of pixels with data for the fits')
+    parser.add_argument('--skip', nargs='*', default=[], help='benchmarks to skip')
+    args = parser.parse_args()
+
+    main(args.output, raw_data_file=args.raw_data_file, n_words=args.n_words, fit_pixels=args.fit_pixels, skip=args.skip, reference_file=args.compare)
@@ -11,7 +11,6 @@ import tables as tb
 from numba import njit
 
 from tjmonopix2.analysis import analysis_utils as au
-from tjmonopix2.analysis import analysis, plotting
 from tjmonopix2.scans.scan_threshold import ThresholdScan
 
 scan_configuration = {
@@ -28,12 +27,12 @@ scan_configuration = {
 }
 
 
-@njit
+@njit(cache=True)
 def _calc_mean_avg(array, weights):
     return np.sum(array * weights) / np.sum(weights)
 
 
-@njit
+@njit(cache=True)
 def _create_tot_avg(array):
     original_shape = array.shape
     array = array.reshape((original_shape[0] * original_shape[1], original_shape[2], original_shape[3]))
@@ -52,6 +51,7 @@ class CalibrateToT(ThresholdScan):
     scan_id = 'calibrate_tot'
 
     def _analyze(self):
+        from tjmonopix2.analysis import analysis, plotting
         with analysis.Analysis(raw_data_file=self.output_filename + '.h5', **self.configuration['bench']['analysis']) as a:
             a.analyze_data()
 
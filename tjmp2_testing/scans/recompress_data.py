@@ -0,0 +1,62 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Offline re-compression of finished run files, e.g. to convert data taken with the
+    fast capture profile to the archival profile:
+
+        python recompress_data.py output_data/module_0/chip_0/*_scan.h5 --profile archival
+'''
+
+import argparse
+import glob
+import os
+
+import tables as tb
+from tqdm import tqdm
+
+from tjmonopix2.analysis.analysis_utils import COMPRESSION_PROFILES
+from tjmonopix2.system import logger
+
+log = logger.setup_derived_logger('Recompress')
+
+
+def recompress(in_file, out_file=None, profile='archival'):
+    ''' Copies all nodes of in_file to out_file using the filters of the given compression profile.
+
+        If out_file is None the input file is replaced once the copy is complete.
+    '''
+    filters = COMPRESSION_PROFILES[profile]
+    replace = out_file is None
+    if replace:
+        out_file = os.path.splitext(in_file)[0] + '_' + profile + '.h5.tmp'
+    with tb.open_file(in_file, mode='r') as in_h5, tb.open_file(out_file, mode='w', title=in_h5.title, filters=filters) as out_h5:
+        in_h5.root._v_attrs._f_copy(out_h5.root)
+        in_h5.root._f_copy_children(out_h5.root, recursive=True, filters=filters)  # tb.copy_file keeps the filters of the nodes
+    if replace:
+        os.replace(out_file, in_file)
+        out_file = in_file
+    return out_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-compress run files with one of the compression profiles')
+    parser.add_argument('files', nargs='+', help='h5 files or glob patterns')
+    parser.add_argument('--profile', default='archival', choices=sorted(COMPRESSION_PROFILES), help='compression profile')
+    parser.add_argument('--suffix', default=None, help='write to <name><suffix>.h5 instead of replacing the input file')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='number of blosc threads')
+    args = parser.parse_args()
+
+    tb.set_blosc_max_threads(args.threads)
+    files = sorted(set(f for pattern in args.files for f in glob.glob(pattern)))
+    size_before, size_after = 0, 0
+    for in_file in tqdm(files):
+        out_file = None if args.suffix is None else os.path.splitext(in_file)[0] + args.suffix + '.h5'
+        size_before += os.path.getsize(in_file)
+        size_after += os.path.getsize(recompress(in_file, out_file, profile=args.profile))
+    if files:
+        log.success('Re-compressed %d files: %.1f MB -> %.1f MB', len(files), size_before / 2 ** 20, size_after / 2 ** 20)
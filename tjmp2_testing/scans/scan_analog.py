@@ -5,7 +5,6 @@
 # ------------------------------------------------------------
 #
 
-from tjmonopix2.analysis import analysis, plotting
 from tjmonopix2.scans.shift_and_inject import (get_scan_loop_mask_steps,
                                                shift_and_inject)
 from tjmonopix2.system.scan_base import ScanBase
@@ -47,6 +46,7 @@ class AnalogScan(ScanBase):
         self.log.success('Scan finished')
 
     def _analyze(self):
+        from tjmonopix2.analysis import analysis, plotting
         with analysis.Analysis(raw_data_file=self.output_filename + '.h5', **self.configuration['bench']['analysis']) as a:
             a.analyze_data()
 
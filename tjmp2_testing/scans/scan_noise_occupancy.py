@@ -11,7 +11,6 @@ import numpy as np
 import tables as tb
 from tqdm import tqdm
 
-from tjmonopix2.analysis import analysis, plotting
 from tjmonopix2.system.scan_base import ScanBase
 
 import yaml
@@ -59,28 +58,7 @@ class NoiseOccScan(ScanBase):
         col_disabled = col_bad
         col_disabled += list(range(0, start_column & 0xfffe))
         col_disabled += list(range(stop_column + 1, 512))
-        reg_values = [0xffff] * 16
-        for col in col_disabled:
-            dcol = col // 2
-            reg_values[dcol//16] &= ~(1 << (dcol % 16))
-        print(" ".join(f"{x:016b}" for x in reg_values))
-        for i, v in enumerate(reg_values):
-            #print(f"test i {enumerate(reg_values)}")
-            # EN_RO_CONFsource /home/labb2/tj-monopix2-daq-development/venv/bin/activate
-            self.chip._write_register(155+i, v)
-            # EN_BCID_CONF (to disable BCID distribution on cols under test, use 0 instead of v, doing this the TOT is 0 since Le and trailing edge are not assigned BCID is missing)
-            # To enable it all the matrix (higher I_LV and Temp), use  self.chip._write_register(171+i, 0xffff)
-            # To enable only the used columns, use  self.chip._write_register(171+i, v)
-            # To disable BCID distribution in all columns, use  self.chip._write_register(171+i, 0)
-            # self.chip._write_register(171+i, v)
-            self.chip._write_register(171+i, 0xffff)
-            # self.chip._write_register(171+i, 0)
-            # EN_RO_RST_CONF
-            self.chip._write_register(187+i, v)
-            # EN_FREEZE_CONF
-            self.chip._write_register(203+i, v)
-            # Read back
-            print(f"{i:3d} {v:016b} {self.chip._get_register_value(155+i):016b} {self.chip._get_register_value(171+i):016b} {self.chip._get_register_value(187+i):016b} {self.chip._get_register_value(203+i):016b}")
+        self.chip.configure_column_readout(disabled_columns=col_disabled)
 
 
 
@@ -162,6 +140,7 @@ class NoiseOccScan(ScanBase):
         self.log.success('Scan finished')
 
     def _analyze(self):
+        from tjmonopix2.analysis import analysis, plotting
         with analysis.Analysis(raw_data_file=self.output_filename + '.h5', **self.configuration['bench']['analysis']) as a:
             a.analyze_data()
             with tb.open_file(a.analyzed_data_file) as in_file:
@@ -11,7 +11,6 @@ from tqdm import tqdm
 
 import yaml
 
-from tjmonopix2.analysis import analysis, plotting
 from tjmonopix2.system.scan_base import ScanBase
 
 scan_configuration = {
@@ -73,28 +72,7 @@ class SourceScan(ScanBase):
         col_disabled = col_bad
         col_disabled += list(range(0, start_column & 0xfffe))
         col_disabled += list(range(stop_column + 1, 512))
-        reg_values = [0xffff] * 16
-        for col in col_disabled:
-            dcol = col // 2
-            reg_values[dcol//16] &= ~(1 << (dcol % 16))
-        print(" ".join(f"{x:016b}" for x in reg_values))
-        for i, v in enumerate(reg_values):
-            # EN_RO_CONF
-            self.chip._write_register(155+i, v)
-            # EN_BCID_CONF (to disable BCID distribution on cols under test, use 0 instead of v, doing this the TOT is 0 since Le and trailing edge are not assigned BCID is missing)
-            # if below is commented the BCID seems to be enabled in all the matrix higher I_LV and Temp
-            # To enable it all the matrix (higher I_LV and Temp), use  self.chip._write_register(171+i, 0xffff)
-            # To enable only the used columns, use  self.chip._write_register(171+i, v)
-            # To disable BCID distribution in all columns, use  self.chip._write_register(171+i, 0)
-            self.chip._write_register(171+i, 0xffff)
-            #self.chip._write_register(171+i, 0)
-            #self.chip._write_register(171+i, v)
-            # EN_RO_RST_CONF
-            self.chip._write_register(187+i, v)
-            # EN_FREEZE_CONF
-            self.chip._write_register(203+i, v)
-            # Read back
-            print(f"{i:3d} {v:016b} {self.chip._get_register_value(155+i):016b} {self.chip._get_register_value(171+i):016b} {self.chip._get_register_value(187+i):016b} {self.chip._get_register_value(203+i):016b}")
+        self.chip.configure_column_readout(disabled_columns=col_disabled)
 
 
 
@@ -227,6 +205,7 @@ class SourceScan(ScanBase):
         self.log.success('Scan finished')
 
     def _analyze(self):
+        from tjmonopix2.analysis import analysis, plotting
         tot_calib_file = self.configuration['scan'].get('tot_calib_file', None)
         if tot_calib_file is not None:
             self.configuration['bench']['analysis']['cluster_hits'] = True
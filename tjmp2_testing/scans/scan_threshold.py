@@ -5,7 +5,9 @@
 # ------------------------------------------------------------
 #
 
-from tjmonopix2.analysis import analysis, plotting
+import numpy as np
+
+from tjmonopix2.analysis import online as oa
 from tjmonopix2.scans.shift_and_inject import (get_scan_loop_mask_steps,
                                                shift_and_inject)
 from tjmonopix2.system.scan_base import ScanBase
@@ -111,49 +113,7 @@ class ThresholdScan(ScanBase):
         col_disabled = list(col_bad)
         col_disabled += list(range(0, start_column & 0xfffe))
         col_disabled += list(range(stop_column + 1, 512))
-        reg_values = [0xffff] * 16
-        for col in col_disabled:
-            dcol = col // 2
-            reg_values[dcol//16] &= ~(1 << (dcol % 16))
-        print(" ".join(f"{x:016b}" for x in reg_values))
-        for i, v in enumerate(reg_values):
-            #print(f"test i {enumerate(reg_values)}")
-            # EN_RO_CONFsource /home/labb2/tj-monopix2-daq-development/venv/bin/activate
-            self.chip._write_register(155+i, v)
-            # EN_BCID_CONF (to disable BCID distribution on cols under test, use 0 instead of v, doing this the TOT is 0 since Le and trailing edge are not assigned BCID is missing)
-            # To enable it all the matrix (higher I_LV and Temp), use  self.chip._write_register(171+i, 0xffff)
-            # To enable only the used columns, use  self.chip._write_register(171+i, v)
-            # To disable BCID distribution in all columns, use  self.chip._write_register(171+i, 0)
-            # self.chip._write_register(171+i, v)
-            # self.chip._write_register(171+i, 0xffff)
-            # self.chip._write_register(171+i, 0)
-            # EN_RO_RST_CONF
-            self.chip._write_register(187+i, v)
-            # EN_FREEZE_CONF
-            self.chip._write_register(203+i, v)
-            # Read back
-            # print(f"{i:3d} {v:016b} {self.chip._get_register_value(155+i):016b} {self.chip._get_register_value(171+i):016b} {self.chip._get_register_value(187+i):016b} {self.chip._get_register_value(203+i):016b}")
-
-        # Disable BCID for double-columns of col_disabled
-        col_disabled_BCID = list(col_bad)
-        # col_disabled_BCID += list(range(0,256))
-        reg_values = [0xffff] * 16
-        for col in col_disabled_BCID:
-            dcol = col // 2
-            reg_values[dcol//16] &= ~(1 << (dcol % 16))
-            # print(f"Disabling BCID in col {col}")
-        print(" ".join(f"{x:016b}" for x in reg_values))
-        for i, v in enumerate(reg_values):
-            # EN_BCID_CONF (to disable BCID distribution on cols under test, use 0 instead of v, doing this the TOT is 0 since Le and trailing edge are not assigned BCID is missing)
-            # To enable it all the matrix (higher I_LV and Temp), use  self.chip._write_register(171+i, 0xffff)
-            # To enable only the used columns, use  self.chip._write_register(171+i, v)
-            # To disable BCID distribution in all columns, use  self.chip._write_register(171+i, 0)
-            # self.chip._write_register(171+i, v)
-            self.chip._write_register(171+i, 0xffff)
-            # self.chip._write_register(171+i, 0)
-            # Read back
-            # print(f"Writing to BCID: {v:016b}")
-            print(f"{i:3d} {v:016b} {self.chip._get_register_value(155+i):016b} {self.chip._get_register_value(171+i):016b} {self.chip._get_register_value(187+i):016b} {self.chip._get_register_value(203+i):016b}")
+        self.chip.configure_column_readout(disabled_columns=col_disabled)
 
         self.chip.masks.apply_disable_mask()
         self.chip.masks.update(force=True)
@@ -339,20 +299,41 @@ class ThresholdScan(ScanBase):
         self.chip.registers["VH"].write(VCAL_HIGH)
         vcal_low_range = range(VCAL_LOW_start, VCAL_LOW_stop, VCAL_LOW_step)
 
-        pbar = tqdm(total=get_scan_loop_mask_steps(self.chip) * len(vcal_low_range), unit='Mask steps')
-        for scan_param_id, vcal_low in enumerate(vcal_low_range):
-            self.chip.registers["VL"].write(vcal_low)
-
-            self.store_scan_par_values(scan_param_id=scan_param_id, vcal_high=VCAL_HIGH, vcal_low=vcal_low)
-            with self.readout(scan_param_id=scan_param_id):
-                #shift_and_inject(chip=self.chip, n_injections=n_injections, pbar=pbar, scan_param_id=scan_param_id)
-                shift_and_inject(chip=self.chip, n_injections=n_injections, pbar=pbar, scan_param_id=scan_param_id,PulseStartCnfg=19)
-                # if we want to measure ANAMON0 and ANAMON1 at the same time, the following line inject in all rows at the same time
-                # self.chip.inject(PulseStartCnfg=19, PulseStopCnfg=19+900, repetitions=n_injections, wait_cycles=1, latency=1400)
-        pbar.close()
+        # Live threshold map from fit-less S-curve approximation
+        self.data.hist_scurve = oa.SCurveHistogramming(scan_params=[VCAL_HIGH - vcal_low for vcal_low in vcal_low_range],
+                                                       n_injections=n_injections)
+
+        try:
+            pbar = tqdm(total=get_scan_loop_mask_steps(self.chip) * len(vcal_low_range), unit='Mask steps')
+            for scan_param_id, vcal_low in enumerate(vcal_low_range):
+                self.chip.registers["VL"].write(vcal_low)
+
+                self.store_scan_par_values(scan_param_id=scan_param_id, vcal_high=VCAL_HIGH, vcal_low=vcal_low)
+                with self.readout(scan_param_id=scan_param_id, callback=self.analyze_data_online):
+                    #shift_and_inject(chip=self.chip, n_injections=n_injections, pbar=pbar, scan_param_id=scan_param_id)
+                    shift_and_inject(chip=self.chip, n_injections=n_injections, pbar=pbar, scan_param_id=scan_param_id, cache=True, PulseStartCnfg=19)
+                    # if we want to measure ANAMON0 and ANAMON1 at the same time, the following line inject in all rows at the same time
+                    # self.chip.inject(PulseStartCnfg=19, PulseStopCnfg=19+900, repetitions=n_injections, wait_cycles=1, latency=1400)
+                self._publish_threshold_map(n_scan_params=scan_param_id + 1)
+            pbar.close()
+        finally:
+            self.data.hist_scurve.close()  # stop analysis process, also if the scan fails
         self.log.success('Scan finished')
 
+    def _publish_threshold_map(self, n_scan_params):
+        ''' Update the live threshold and noise map with the scan parameters done so far '''
+        self.data.threshold_map, self.data.noise_map = self.data.hist_scurve.get_maps(n_scan_params=n_scan_params)
+        n_pixels = np.count_nonzero(~np.isnan(self.data.threshold_map))
+        if n_pixels:
+            self.log.info('Online threshold after {0} steps: {1:1.2f} +- {2:1.2f} Delta VCAL (noise {3:1.2f}) from {4} pixels with hits'.format(
+                n_scan_params, np.nanmedian(self.data.threshold_map), np.nanstd(self.data.threshold_map), np.nanmedian(self.data.noise_map), n_pixels))
+
+    def analyze_data_online(self, data_tuple):
+        self.data.hist_scurve.add(data_tuple[0], scan_param_id=self.scan_param_id)
+        super(ThresholdScan, self).handle_data(data_tuple)
+
     def _analyze(self):
+        from tjmonopix2.analysis import analysis, plotting
         with analysis.Analysis(raw_data_file=self.output_filename + '.h5', **self.configuration['bench']['analysis']) as a:
             a.analyze_data()
 
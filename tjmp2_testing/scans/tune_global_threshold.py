@@ -14,7 +14,6 @@ from tqdm import tqdm
 
 from tjmonopix2.system.scan_base import ScanBase
 from tjmonopix2.scans.shift_and_inject import shift_and_inject
-from tjmonopix2.analysis import online as oa
 
 
 scan_configuration = {
@@ -38,6 +37,7 @@ scan_configuration = {
 
 class GDACTuning(ScanBase):
     scan_id = 'global_threshold_tuning'
+    online_histograms = ('occupancy', )
 
     def _configure(self, start_column=0, stop_column=512, start_row=0, stop_row=512, VCAL_LOW=30, VCAL_HIGH=60, **_):
         '''
@@ -71,8 +71,6 @@ class GDACTuning(ScanBase):
 
         self.chip.registers["SEL_PULSE_EXT_CONF"].write(0)
 
-        self.data.hist_occ = oa.OccupancyHistogramming()
-
     def _scan(self, n_injections=100, gdac_value_bits=range(6, -1, -1), **_):
         '''
         Global threshold tuning main loop
@@ -152,7 +150,6 @@ class GDACTuning(ScanBase):
         # Set final result
         self.data.best_gdacs = best_gdacs
         write_gdac_registers(best_gdacs)
-        self.data.hist_occ.close()  # stop analysis process
 
     def get_occupancy(self, scan_param_id, n_injections):
         ''' Analog scan and stuck pixel scan '''
@@ -161,18 +158,18 @@ class GDACTuning(ScanBase):
         with self.readout(scan_param_id=scan_param_id, callback=self.analyze_data_online):
             shift_and_inject(chip=self.chip, n_injections=n_injections, pbar=self.data.pbar, scan_param_id=scan_param_id)
         # Get hit occupancy using online analysis
-        occupancy = self.data.hist_occ.get()
+        occupancy = self.online_histogramming.get(receiver=self.chip.receiver)['occupancy']
 
         return occupancy
 
     def analyze_data_online(self, data_tuple):
         raw_data = data_tuple[0]
-        self.data.hist_occ.add(raw_data)
+        self.online_histogramming.add(raw_data, receiver=self.chip.receiver)
         super(GDACTuning, self).handle_data(data_tuple)
 
     def analyze_data_online_no_save(self, data_tuple):
         raw_data = data_tuple[0]
-        self.data.hist_occ.add(raw_data)
+        self.online_histogramming.add(raw_data, receiver=self.chip.receiver)
 
     def _analyze(self):
         pass
@@ -15,7 +15,6 @@ import numpy as np
 
 from tjmonopix2.system.scan_base import ScanBase
 from tjmonopix2.scans.shift_and_inject import shift_and_inject, get_scan_loop_mask_steps
-from tjmonopix2.analysis import online as oa
 
 import yaml
 
@@ -35,6 +34,7 @@ scan_configuration = {
 
 class TDACTuning(ScanBase):
     scan_id = 'local_threshold_tuning'
+    online_histograms = ('occupancy', )
 
     def _configure(self, start_column=0, stop_column=512, start_row=0, stop_row=512, VCAL_LOW=30, VCAL_HIGH=60, **_):
         '''
@@ -82,27 +82,7 @@ class TDACTuning(ScanBase):
         col_disabled = col_bad
         col_disabled += list(range(0, start_column & 0xfffe))
         col_disabled += list(range(stop_column + 1, 512))
-        reg_values = [0xffff] * 16
-        for col in col_disabled:
-            dcol = col // 2
-            reg_values[dcol//16] &= ~(1 << (dcol % 16))
-        print(" ".join(f"{x:016b}" for x in reg_values))
-        for i, v in enumerate(reg_values):
-            # EN_RO_CONFsource /home/labb2/tj-monopix2-daq-development/venv/bin/activate
-            self.chip._write_register(155+i, v)
-            # EN_BCID_CONF (to disable BCID distribution on cols under test, use 0 instead of v, doing this the TOT is 0 since Le and trailing edge are not assigned BCID is missing)
-            # To enable it all the matrix (higher I_LV and Temp), use  self.chip._write_register(171+i, 0xffff)
-            # To enable only the used columns, use  self.chip._write_register(171+i, v)
-            # To disable BCID distribution in all columns, use  self.chip._write_register(171+i, 0)
-            #self.chip._write_register(171+i, v)
-            self.chip._write_register(171+i, 0xffff)
-            # self.chip._write_register(171+i, 0)
-            # EN_RO_RST_CONF
-            self.chip._write_register(187+i, v)
-            # EN_FREEZE_CONF
-            self.chip._write_register(203+i, v)
-            # Read back
-            print(f"{i:3d} {v:016b} {self.chip._get_register_value(155+i):016b} {self.chip._get_register_value(171+i):016b} {self.chip._get_register_value(187+i):016b} {self.chip._get_register_value(203+i):016b}")
+        self.chip.configure_column_readout(disabled_columns=col_disabled)
 
 
 
@@ -177,8 +157,6 @@ class TDACTuning(ScanBase):
 
         self.chip.registers["SEL_PULSE_EXT_CONF"].write(0)
 
-        self.data.hist_occ = oa.OccupancyHistogramming()
-
     def _scan(self, start_column=0, stop_column=512, start_row=0, stop_row=512, n_injections=100, **_):
         '''
         Global threshold tuning main loop
@@ -224,7 +202,7 @@ class TDACTuning(ScanBase):
             with self.readout(scan_param_id=scan_param, callback=self.analyze_data_online):
                 shift_and_inject(chip=self.chip, n_injections=n_injections, pbar=pbar, scan_param_id=scan_param,PulseStartCnfg=19)
             # Get hit occupancy using online analysis
-            occupancy = self.data.hist_occ.get()
+            occupancy = self.online_histogramming.get(receiver=self.chip.receiver)['occupancy']
             print("Occupancy =", occupancy[start_column:stop_column, start_row:stop_row])
 
             # Calculate best (closest to target) TDAC setting and update TDAC setting according to hit occupancy
@@ -244,7 +222,6 @@ class TDACTuning(ScanBase):
         self.data.tdac_map[:, :] = best_results_map[:, :, 0]
 
         pbar.close()
-        self.data.hist_occ.close()  # stop analysis process
         self.log.success('Scan finished')
 
         enable_mask = self.chip.masks['enable'][start_column:stop_column, start_row:stop_row]
@@ -255,12 +232,12 @@ class TDACTuning(ScanBase):
 
     def analyze_data_online(self, data_tuple):
         raw_data = data_tuple[0]
-        self.data.hist_occ.add(raw_data)
+        self.online_histogramming.add(raw_data, receiver=self.chip.receiver)
         super(TDACTuning, self).handle_data(data_tuple)
 
     def analyze_data_online_no_save(self, data_tuple):
         raw_data = data_tuple[0]
-        self.data.hist_occ.add(raw_data)
+        self.online_histogramming.add(raw_data, receiver=self.chip.receiver)
 
     def _analyze(self):
         pass
@@ -5,12 +5,16 @@
 # ------------------------------------------------------------
 #
 
-import datetime
+import os
+import shutil
 import sys
+import tempfile
 from collections import deque
-from queue import Empty, Queue
-from threading import Event, Thread
-from time import mktime, sleep, time
+from itertools import count
+from threading import Condition, Event, Thread
+from time import perf_counter, perf_counter_ns, sleep, time
+
+import numpy as np
 
 from tjmonopix2.system import logger
 
@@ -37,8 +41,213 @@ class StopTimeout(Exception):
     pass
 
 
+class DataQueue(object):
+    '''
+        Bounded queue of readouts between readout and worker thread with the interface of collections.deque.
+
+        If maxsize readouts or max_bytes of data are queued the overflow policy decides:
+            'block': the readout thread waits until the worker took data
+            'spill': readouts are written to temporary files and read back in order
+            'drop': readouts are discarded and counted
+        None (stop signal for the worker) is always accepted.
+    '''
+    policies = ('block', 'spill', 'drop')
+
+    def __init__(self, maxsize=10000, max_bytes=2 ** 30, policy='block'):
+        if policy not in self.policies:
+            raise ValueError('Unknown overflow policy %s, use one of %s' % (policy, ', '.join(self.policies)))
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._memory = deque()
+        self._spilled = deque()  # (filename or None, dtype, timestamp_start, timestamp_stop, status, nbytes)
+        self._spill_dir = None
+        self._spill_index = count()  # spill file names, not reset with the metrics since spilled readouts can still be queued
+        self._not_full = Condition()
+        self._memory_bytes = 0
+        self._spilled_bytes = 0
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.n_dropped = 0
+        self.n_dropped_words = 0
+        self.n_spilled = 0
+        self.max_depth = 0
+        self.max_bytes_in_flight = 0
+        self.max_latency = 0.
+        self.last_latency = 0.
+
+    def __len__(self):
+        return len(self._memory) + len(self._spilled)
+
+    @property
+    def bytes_in_flight(self):
+        return self._memory_bytes + self._spilled_bytes
+
+    def _is_full(self):
+        return len(self._memory) >= self.maxsize or self._memory_bytes >= self.max_bytes
+
+    def append(self, item):
+        if item is None:
+            if self._spilled:  # keep order
+                self._spilled.append(None)
+            else:
+                self._memory.append(None)
+            return
+        nbytes = item[0].nbytes
+        with self._not_full:
+            if self.policy == 'block':
+                while self._is_full():
+                    self._not_full.wait(0.1)
+            elif self.policy == 'drop' and self._is_full():
+                self.n_dropped += 1
+                self.n_dropped_words += item[0].shape[0]
+                return
+        if self.policy == 'spill' and (self._spilled or self._is_full()):  # once spilling all data has to be spilled to keep order
+            self._spill(item)
+        else:
+            self._memory.append(item)
+            self._memory_bytes += nbytes
+        self.max_depth = max(self.max_depth, len(self))
+        self.max_bytes_in_flight = max(self.max_bytes_in_flight, self.bytes_in_flight)
+
+    def popleft(self):
+        try:
+            item = self._memory.popleft()
+        except IndexError:
+            item = self._unspill()  # raises IndexError if empty
+        else:
+            if item is not None:
+                self._memory_bytes -= item[0].nbytes
+                with self._not_full:
+                    self._not_full.notify()
+        return item
+
+    def clear(self):
+        self._memory.clear()
+        self._spilled.clear()
+        self._memory_bytes = 0
+        self._spilled_bytes = 0
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    def _spill(self, item):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix='tjmonopix2_readout_')
+        data, timestamp_start, timestamp_stop, status = item
+        filename = os.path.join(self._spill_dir, '%d.bin' % next(self._spill_index))
+        data.tofile(filename)
+        self._spilled.append((filename, data.dtype, timestamp_start, timestamp_stop, status, data.nbytes))
+        self._spilled_bytes += data.nbytes
+        self.n_spilled += 1
+
+    def _unspill(self):
+        entry = self._spilled.popleft()
+        if entry is None:
+            return None
+        filename, dtype, timestamp_start, timestamp_stop, status, nbytes = entry
+        data = np.fromfile(filename, dtype=dtype)
+        os.remove(filename)
+        self._spilled_bytes -= nbytes
+        return (data, timestamp_start, timestamp_stop, status)
+
+    def record_latency(self, latency):
+        ''' Time between readout and callback of the oldest readout handed to the callback '''
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def get_metrics(self):
+        return {'depth': len(self),
+                'max_depth': self.max_depth,
+                'bytes_in_flight': self.bytes_in_flight,
+                'max_bytes_in_flight': self.max_bytes_in_flight,
+                'latency': self.last_latency,
+                'max_latency': self.max_latency,
+                'n_spilled': self.n_spilled,
+                'n_dropped': self.n_dropped,
+                'n_dropped_words': self.n_dropped_words}
+
+
+class ReadoutTelemetry(object):
+    '''
+        Lightweight readout performance metrics.
+
+        Filled by the readout thread (words, read latency), the worker thread (callback duration)
+        and the watchdog thread (FIFO fill level, 8b10b error and discard counters).
+    '''
+
+    def __init__(self, moving_average_time_period=10.0):
+        self.moving_average_time_period = moving_average_time_period
+        self._window = deque()  # (timestamp, words) of the readouts within the moving average time period
+        self._window_words = 0
+        self.reset()
+
+    def reset(self):
+        self._window.clear()
+        self._window_words = 0
+        self.n_readouts = 0
+        self.n_words = 0
+        self.read_time = 0.
+        self.last_read_latency = 0.
+        self.max_read_latency = 0.
+        self.n_callbacks = 0
+        self.callback_time = 0.
+        self.last_callback_duration = 0.
+        self.max_callback_duration = 0.
+        self.fifo_size = 0
+        self.max_fifo_size = 0
+        self.rx_8b10b_errors = []
+        self.rx_discard_counts = []
+
+    def add_readout(self, timestamp, n_words, latency):
+        self.n_readouts += 1
+        self.n_words += n_words
+        self.read_time += latency
+        self.last_read_latency = latency
+        self.max_read_latency = max(self.max_read_latency, latency)
+        self._window.append((timestamp, n_words))
+        self._window_words += n_words
+        while self._window and self._window[0][0] < timestamp - self.moving_average_time_period:
+            self._window_words -= self._window.popleft()[1]
+
+    def add_callback(self, duration):
+        self.n_callbacks += 1
+        self.callback_time += duration
+        self.last_callback_duration = duration
+        self.max_callback_duration = max(self.max_callback_duration, duration)
+
+    def add_status(self, fifo_size, rx_8b10b_errors, rx_discard_counts):
+        self.fifo_size = fifo_size
+        self.max_fifo_size = max(self.max_fifo_size, fifo_size)
+        self.rx_8b10b_errors = list(rx_8b10b_errors)
+        self.rx_discard_counts = list(rx_discard_counts)
+
+    def words_per_second(self):
+        return self._window_words / float(self.moving_average_time_period)
+
+    def get_summary(self):
+        '''
+            Metrics as dict of plain python types, e.g. to store in a table or to send as JSON.
+        '''
+        return {'n_readouts': self.n_readouts,
+                'n_words': self.n_words,
+                'words_per_second': self.words_per_second(),
+                'read_time': self.read_time,
+                'read_latency': self.last_read_latency,
+                'max_read_latency': self.max_read_latency,
+                'n_callbacks': self.n_callbacks,
+                'callback_time': self.callback_time,
+                'callback_duration': self.last_callback_duration,
+                'max_callback_duration': self.max_callback_duration,
+                'fifo_size': int(self.fifo_size),
+                'max_fifo_size': int(self.max_fifo_size),
+                'rx_8b10b_errors': [int(count) for count in self.rx_8b10b_errors],
+                'rx_discard_counts': [int(count) for count in self.rx_discard_counts]}
+
+
 class FifoReadout(object):
-    def __init__(self, daq):
+    def __init__(self, daq, queue_size=10000, queue_max_bytes=2 ** 30, overflow_policy='block'):
         self.log = logger.setup_derived_logger('FIFO Readout')
 
         self.daq = daq
@@ -48,16 +257,22 @@ class FifoReadout(object):
         self.worker_thread = None
         self.watchdog_thread = None
         self.fill_buffer = False
+        # Adaptive readout interval: shortened when a lot of data is read, lengthened when idle
         self.readout_interval = 0.05
+        self.min_readout_interval = 0.001
+        self.max_readout_interval = 0.05
+        self.high_watermark = 2 ** 15  # words per read above which the readout interval is shortened
+        self.low_watermark = 2 ** 10  # words per read below which the readout interval is lengthened
+        self.max_batch_words = 2 ** 22  # max. words of pending readouts combined into one callback
         self._moving_average_time_period = 10.0
-        self._data_deque = deque()
+        self._data_deque = DataQueue(maxsize=queue_size, max_bytes=queue_max_bytes, policy=overflow_policy)
+        self._data_available = Event()
         self._data_buffer = deque()
-        self._words_per_read = deque(maxlen=int(self._moving_average_time_period / self.readout_interval))
-        self._result = Queue(maxsize=1)
-        self._calculate = Event()
+        self.telemetry = ReadoutTelemetry(moving_average_time_period=self._moving_average_time_period)
         self.stop_readout = Event()
         self.force_stop = Event()
         self.timestamp = None
+        self._anchor_time()
         self.update_timestamp()
         self._is_running = False
         self.reset_rx()
@@ -82,16 +297,23 @@ class FifoReadout(object):
         else:
             self.log.warning('Data requested but software data buffer not active')
 
+    @property
+    def queue_metrics(self):
+        '''
+            Live metrics of the data queue between readout and worker thread: depth, bytes in flight, latency and drop/spill counters.
+        '''
+        return self._data_deque.get_metrics()
+
+    def get_telemetry(self):
+        '''
+            Readout telemetry and data queue metrics as flat dict
+        '''
+        telemetry = self.telemetry.get_summary()
+        telemetry.update(('queue_' + name, value) for name, value in self.queue_metrics.items())
+        return telemetry
+
     def data_words_per_second(self):
-        if self._result.full():
-            self._result.get()
-        self._calculate.set()
-        try:
-            result = self._result.get(timeout=2 * self.readout_interval)
-        except Empty:
-            self._calculate.clear()
-            return None
-        return result / float(self._moving_average_time_period)
+        return self.telemetry.words_per_second()
 
     def start(self, callback=None, errback=None, reset_rx=False, reset_sram_fifo=False, clear_buffer=False, fill_buffer=False, no_data_timeout=None):
         if self._is_running:
@@ -99,6 +321,7 @@ class FifoReadout(object):
 
         self._is_running = True
         self.log.debug('Starting FIFO readout...')
+        self._anchor_time()
         self.callback = callback
         self.errback = errback
         self.fill_buffer = fill_buffer
@@ -111,7 +334,8 @@ class FifoReadout(object):
             fifo_size = self.daq['FIFO']['FIFO_SIZE']
             if fifo_size != 0:
                 self.log.warning('FIFO not empty when starting FIFO readout: size = %i', fifo_size)
-        self._words_per_read.clear()
+        self.readout_interval = self.max_readout_interval
+        self._data_deque.reset_metrics()
         if clear_buffer:
             self._data_deque.clear()
             self._data_buffer.clear()
@@ -154,6 +378,12 @@ class FifoReadout(object):
             self.watchdog_thread.join()
         if self.callback:
             self.worker_thread.join()
+        metrics = self.queue_metrics
+        if metrics['n_dropped']:
+            self.log.warning('Data queue overflow: dropped %d readouts with %d words', metrics['n_dropped'], metrics['n_dropped_words'])
+        if metrics['n_spilled']:
+            self.log.warning('Data queue overflow: %d readouts were spilled to disk', metrics['n_spilled'])
+        self.log.debug('Data queue: max. depth %d, max. %d bytes in flight, max. latency %0.3f s', metrics['max_depth'], metrics['max_bytes_in_flight'], metrics['max_latency'])
         self.callback = None
         self.errback = None
         self.log.debug('Stopped FIFO readout')
@@ -170,6 +400,7 @@ class FifoReadout(object):
             self.log.warning('RX errors detected')
             self.log.warning('Recived words:               %d', self._record_count)
             self.log.warning('Data queue size:             %d', queue_size)
+            self.log.warning('Data queue dropped:          %d', self._data_deque.n_dropped)
             self.log.warning('FIFO size:                   %d', self.daq['FIFO']['FIFO_SIZE'])
             self.log.warning('Channel:                     %s', " | ".join([channel.name.rjust(3) for _, channel in sorted(self.daq.rx_channels.items())]))
             # self.log.warning('RX sync:                     %s', " | ".join(["YES".rjust(3) if status is True else "NO".rjust(3) for status in sync_status]))
@@ -188,10 +419,11 @@ class FifoReadout(object):
         time_wait = 0.0
         while not self.force_stop.wait(time_wait if time_wait >= 0.0 else 0.0):
             try:
-                time_read = time()
+                time_read = perf_counter()
                 if no_data_timeout and curr_time + no_data_timeout < self.get_float_time():
                     raise NoDataTimeout('Received no data for %0.1f second(s)' % no_data_timeout)
                 data = self.read_data()
+                read_latency = perf_counter() - time_read
                 self._record_count += len(data)
             except Exception:
                 no_data_timeout = None  # raise exception only once
@@ -207,39 +439,90 @@ class FifoReadout(object):
                 status = 0
                 if self.callback:
                     self._data_deque.append((data, last_time, curr_time, status))
+                    self._data_available.set()
                 if self.fill_buffer:
                     self._data_buffer.append((data, last_time, curr_time, status))
-                self._words_per_read.append(n_words)
+                self.telemetry.add_readout(curr_time, n_words, read_latency)
+                self._adapt_readout_interval(n_words)
                 # FIXME: busy FE prevents scan termination? To be checked
                 if self.stop_readout.is_set():
                     break
             finally:
-                time_wait = self.readout_interval - (time() - time_read)
-            if self._calculate.is_set():
-                self._calculate.clear()
-                self._result.put(sum(self._words_per_read))
+                time_wait = self.readout_interval - (perf_counter() - time_read)
         if self.callback:
             self._data_deque.append(None)  # last item, will stop worker
+            self._data_available.set()
         self.log.debug('Stopped %s', self.readout_thread.name)
 
+    def _adapt_readout_interval(self, n_words):
+        '''
+            Shorten the readout interval if the FIFO fills up fast, lengthen it if there is hardly any data.
+        '''
+        if n_words > self.high_watermark:
+            self.readout_interval = max(self.min_readout_interval, self.readout_interval / 2.)
+        elif n_words < self.low_watermark:
+            self.readout_interval = min(self.max_readout_interval, self.readout_interval * 1.25)
+
+    def _get_batch(self):
+        '''
+            Pop all pending readouts up to max_batch_words. A trailing None (stop worker) is kept in the batch.
+        '''
+        batch = []
+        n_words = 0
+        while n_words < self.max_batch_words:
+            try:
+                data = self._data_deque.popleft()
+            except IndexError:
+                break
+            batch.append(data)
+            if data is None:
+                break
+            n_words += data[0].shape[0]
+        return batch
+
+    def _combine(self, batch):
+        '''
+            Combine several readouts into one data tuple. Only copies if more than one readout has data.
+        '''
+        if len(batch) == 1:
+            return batch[0]
+        with_data = [data[0] for data in batch if data[0].shape[0]]
+        if len(with_data) == 1:
+            raw_data = with_data[0]
+        elif with_data:
+            raw_data = np.concatenate(with_data)
+        else:
+            raw_data = batch[-1][0]
+        status = 0
+        for data in batch:
+            status |= data[3]
+        return (raw_data, batch[0][1], batch[-1][2], status)
+
     def worker(self):
         '''
             Worker thread continuously calling callback function when data is available.
+            Readouts that are pending when the callback returns are combined into one callback call.
         '''
         self.log.debug('Starting %s', self.worker_thread.name)
         while True:
-            try:
-                data = self._data_deque.popleft()
-            except IndexError:
-                self.stop_readout.wait(self.readout_interval)  # sleep a little bit, reducing CPU usage
-            else:
-                if data is None:  # if None then exit
-                    break
-                else:
-                    try:
-                        self.callback(data)
-                    except Exception:
-                        self.errback(sys.exc_info())
+            batch = self._get_batch()
+            if not batch:
+                self._data_available.wait(self.max_readout_interval)  # sleep until new data, reducing CPU usage
+                self._data_available.clear()
+                continue
+            stop = batch[-1] is None  # if None then exit after callback
+            if stop:
+                batch.pop()
+            if batch:
+                self._data_deque.record_latency(self.get_float_time() - batch[0][2])
+                time_callback = perf_counter()
+                try:
+                    self.callback(self._combine(batch))
+                except Exception:
+                    self.errback(sys.exc_info())
+                self.telemetry.add_callback(perf_counter() - time_callback)
+            if stop:
+                break
 
         self.log.debug('Stopped %s', self.worker_thread.name)
 
@@ -248,14 +531,17 @@ class FifoReadout(object):
         while True:
             try:
                 error_count = self.get_rx_8b10b_error_count()
+                discard_count = self.get_rx_fifo_discard_count()
+                self.telemetry.add_status(self.daq['FIFO']['FIFO_SIZE'], error_count, discard_count)
                 if any(error_count):
                     raise EightbTenbError('RX 8b10b error(s) detected ', error_count)
-                discard_count = self.get_rx_fifo_discard_count()
                 if any(discard_count):
                     raise FifoDiscardError('RX FIFO discard error(s) detected ', discard_count)
+                if len(self._data_deque) > 0.8 * self._data_deque.maxsize or self._data_deque.bytes_in_flight > 0.8 * self._data_deque.max_bytes:
+                    self.log.warning('Data queue almost full: %d readouts, %d bytes in flight, latency %0.3f s', len(self._data_deque), self._data_deque.bytes_in_flight, self._data_deque.last_latency)
             except Exception:
                 self.errback(sys.exc_info())
-            if self.stop_readout.wait(self.readout_interval * 10):
+            if self.stop_readout.wait(self.max_readout_interval * 10):
                 break
         self.log.debug('Stopped %s', self.watchdog_thread.name)
 
@@ -310,10 +596,18 @@ class FifoReadout(object):
         else:
             return self.daq.rx_channels[rx_channel].get_lost_data_counter()
 
+    def _anchor_time(self):
+        '''
+            Anchor the high resolution performance counter to the wall clock time. Done at every start to avoid drifts.
+        '''
+        self._wall_time_anchor = time()
+        self._perf_counter_anchor = perf_counter_ns()
+
     def get_float_time(self):
         '''
             Returns time as double precision floats - Time64 in pytables - mapping to and from python datetime's
+
+            Wall clock time at the anchor plus the elapsed time of the monotonic performance counter:
+            cheap to call and with sub microsecond resolution.
         '''
-        t1 = time()
-        t2 = datetime.datetime.fromtimestamp(t1)
-        return mktime(t2.timetuple()) + 1e-6 * t2.microsecond
+        return self._wall_time_anchor + (perf_counter_ns() - self._perf_counter_anchor) * 1e-9
@@ -0,0 +1,121 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Opt-in timing of the scan phases (configure, scan, analyze, ...) and of the chip and
+    readout operations within them (mask and register writes, injections, FIFO waits,
+    HDF5 appends). Wall time and CPU time of the calling thread are summed per phase,
+    chip and scan parameter id; optionally every phase is kept for a Chrome trace
+    (chrome://tracing or https://ui.perfetto.dev).
+'''
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+profile_dtype = np.dtype([('phase', 'S32'),
+                          ('category', 'S16'),
+                          ('chip', 'S32'),
+                          ('scan_param_id', '<i4'),
+                          ('calls', '<u8'),
+                          ('wall_time', '<f8'),
+                          ('cpu_time', '<f8')])
+
+_NO_PHASE = nullcontext()
+
+
+class Profiler(object):
+    '''
+        Collects the time spent in phases
+
+        Usage:
+            profiler = Profiler(enabled=True)
+            with profiler.phase('mask_write', 'chip'):
+                chip.masks.update()
+
+        The current chip and scan_param_id are set by the scan and used for all phases
+        that do not set them explicitly. If not enabled, phase() does nothing.
+    '''
+
+    def __init__(self, enabled=False, trace=False, max_trace_events=10 ** 6):
+        self.enabled = enabled
+        self.trace = trace
+        self.max_trace_events = max_trace_events
+        self.chip = ''
+        self.scan_param_id = -1
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._summary = OrderedDict()  # (phase, category, chip, scan_param_id) -> [calls, wall time, cpu time]
+        self._trace_events = []
+        self._start = time.perf_counter()
+
+    def phase(self, name, category='scan', chip=None, scan_param_id=None):
+        if not self.enabled:
+            return _NO_PHASE
+        return self._phase(name, category, self.chip if chip is None else chip, self.scan_param_id if scan_param_id is None else scan_param_id)
+
+    @contextmanager
+    def _phase(self, name, category, chip, scan_param_id):
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self._record(name, category, chip, scan_param_id, start, time.perf_counter() - start, time.thread_time() - cpu_start)
+
+    def _record(self, name, category, chip, scan_param_id, start, wall_time, cpu_time):
+        with self._lock:
+            entry = self._summary.setdefault((name, category, chip, scan_param_id), [0, 0., 0.])
+            entry[0] += 1
+            entry[1] += wall_time
+            entry[2] += cpu_time
+            if self.trace and len(self._trace_events) < self.max_trace_events:
+                self._trace_events.append((name, category, chip, scan_param_id, threading.get_ident(), start, wall_time, cpu_time))
+
+    def get_summary(self, chip=None):
+        ''' Summed times per phase, chip and scan parameter id as structured array; only of chip (and phases without chip) if given '''
+        with self._lock:
+            items = [(key, value) for key, value in self._summary.items() if chip is None or key[2] in (chip, '')]
+        summary = np.zeros(len(items), dtype=profile_dtype)
+        for i, ((name, category, chip_sn, scan_param_id), (calls, wall_time, cpu_time)) in enumerate(items):
+            summary[i] = (name, category, chip_sn, scan_param_id, calls, wall_time, cpu_time)
+        return summary
+
+    def get_phase_times(self, chip=None):
+        ''' Wall time per phase summed over chips and scan parameter ids '''
+        times = OrderedDict()
+        for row in self.get_summary(chip):
+            times[row['phase'].decode()] = times.get(row['phase'].decode(), 0.) + float(row['wall_time'])
+        return times
+
+    def write_table(self, h5_file, node, chip=None):
+        ''' Write the summary into a profile table of the provided node of a h5 file '''
+        h5_file.create_table(node, name='profile', title='Wall and CPU time per phase, chip and scan parameter id', obj=self.get_summary(chip))
+
+    def write_chrome_trace(self, filename):
+        ''' Write the recorded phases in the Chrome trace event format '''
+        with self._lock:
+            events = list(self._trace_events)
+        thread_ids = {}
+        trace_events = []
+        for name, category, chip, scan_param_id, thread_id, start, wall_time, cpu_time in events:
+            trace_events.append({'name': name,
+                                 'cat': category,
+                                 'ph': 'X',
+                                 'ts': (start - self._start) * 1e6,
+                                 'dur': wall_time * 1e6,
+                                 'pid': os.getpid(),
+                                 'tid': thread_ids.setdefault(thread_id, len(thread_ids)),
+                                 'args': {'chip': chip, 'scan_param_id': scan_param_id, 'cpu_time_us': cpu_time * 1e6}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
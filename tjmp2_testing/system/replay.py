@@ -0,0 +1,148 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Replay of recorded runs for load tests of the readout chain and the online monitor.
+
+    The readouts stored in raw_data / meta_data are streamed with their original timing
+    or N times faster to a callback (same data tuple as the FifoReadout callback,
+    e.g. ScanBase.handle_data) and / or a ZMQ socket (same messages as send_data,
+    e.g. for the tjmonopix2_inter converter of the online monitor):
+
+        python replay.py output_data/module_0/chip_0/20221106_224756_source_scan.h5 --speed 10 --socket tcp://127.0.0.1:5500
+'''
+
+import argparse
+import time
+
+import tables as tb
+import zmq
+
+from tjmonopix2.system import logger
+
+
+class RawDataReplay(object):
+    '''
+        Streams the readouts of a raw data file
+
+        Parameters:
+        ----------
+            raw_data_file : str
+                h5 file with raw_data and meta_data nodes
+            speed : float
+                Replay speed relative to the recording, 0 replays as fast as possible
+            restamp : bool
+                Shift the readout timestamps to the replay time (scaled by speed), so that
+                rates calculated from them correspond to the replay
+            chunk_size : int
+                Number of raw data words read from the file at once
+    '''
+
+    def __init__(self, raw_data_file, speed=1., restamp=True, chunk_size=2 ** 22):
+        self.log = logger.setup_derived_logger('Replay')
+        self.raw_data_file = raw_data_file
+        self.speed = speed
+        self.restamp = restamp
+        self.chunk_size = chunk_size
+        self.scan_param_id = 0
+        self.stats = {}
+
+    def iter_readouts(self):
+        ''' Yields the meta data row and raw data of every readout '''
+        with tb.open_file(self.raw_data_file, mode='r') as in_file:
+            meta_data = in_file.root.meta_data[:]
+            raw_data = in_file.root.raw_data
+            buffer, buffer_start, buffer_stop = raw_data[0:0], 0, 0
+            for meta in meta_data:
+                start, stop = int(meta['index_start']), int(meta['index_stop'])
+                if start < buffer_start or stop > buffer_stop:
+                    buffer_start, buffer_stop = start, max(stop, min(start + self.chunk_size, raw_data.shape[0]))
+                    buffer = raw_data[buffer_start:buffer_stop]
+                yield meta, buffer[start - buffer_start:stop - buffer_start]
+
+    def replay(self, callback=None, socket=None, scan_param_callback=None, repeat=1):
+        '''
+            Replay the file repeat times.
+
+            callback(data_tuple) is called for every readout with data_tuple = (raw_data, timestamp_start,
+            timestamp_stop, error), scan_param_callback(scan_param_id) when the scan parameter changes and
+            the readouts are sent to socket (zmq socket or address to bind a publisher socket to).
+
+            Returns the replay statistics.
+        '''
+        if isinstance(socket, str):
+            socket = self._bind_socket(socket)
+        if socket is not None:
+            from tjmonopix2.system.scan_base import send_data  # Needs the online_monitor package
+
+        n_readouts, n_words, max_lag = 0, 0, 0.
+        replay_start = time.time()
+        offset = 0.  # replay time of the current repetition relative to the replay start
+        for _ in range(repeat):
+            first = None
+            for meta, raw_data in self.iter_readouts():
+                if first is None:
+                    first = meta['timestamp_start']
+                elapsed = (meta['timestamp_stop'] - first) / self.speed if self.speed else 0.
+                lag = time.time() - (replay_start + offset + elapsed)
+                if lag < 0:
+                    time.sleep(-lag)
+                else:
+                    max_lag = max(max_lag, float(lag))
+
+                if self.restamp and self.speed:
+                    ts_start = replay_start + offset + (meta['timestamp_start'] - first) / self.speed
+                    ts_stop = replay_start + offset + elapsed
+                elif self.restamp:
+                    ts_start = ts_stop = time.time()
+                else:
+                    ts_start, ts_stop = meta['timestamp_start'], meta['timestamp_stop']
+                data_tuple = (raw_data, float(ts_start), float(ts_stop), int(meta['error']))
+
+                if meta['scan_param_id'] != self.scan_param_id or n_readouts == 0:
+                    self.scan_param_id = int(meta['scan_param_id'])
+                    if scan_param_callback:
+                        scan_param_callback(self.scan_param_id)
+                if callback:
+                    callback(data_tuple)
+                if socket is not None:
+                    send_data(socket, data_tuple, self.scan_param_id)
+                n_readouts += 1
+                n_words += len(raw_data)
+            if first is not None:
+                offset = time.time() - replay_start
+
+        duration = time.time() - replay_start
+        self.stats = {'readouts': n_readouts,
+                      'words': n_words,
+                      'duration': duration,
+                      'words_per_s': n_words / duration if duration else 0.,
+                      'max_lag': max_lag}
+        self.log.info('Replayed %d readouts (%d words) in %1.2f s: %1.2e words/s, max. lag %1.3f s',
+                      n_readouts, n_words, duration, self.stats['words_per_s'], max_lag)
+        return self.stats
+
+    def _bind_socket(self, socket_addr):
+        socket = zmq.Context.instance().socket(zmq.PUB)  # publisher socket
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.bind(socket_addr)
+        self.log.info('Sending data to %s', socket_addr)
+        time.sleep(0.5)  # give subscribers time to connect
+        return socket
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay the raw data of a recorded run')
+    parser.add_argument('raw_data_file', help='h5 file with raw_data and meta_data')
+    parser.add_argument('--speed', type=float, default=1., help='replay speed relative to the recording, 0 = as fast as possible')
+    parser.add_argument('--socket', default='tcp://127.0.0.1:5500', help='address to publish the data on')
+    parser.add_argument('--repeat', type=int, default=1, help='number of repetitions of the run')
+    parser.add_argument('--keep_timestamps', action='store_true', help='send the recorded timestamps')
+    args = parser.parse_args()
+
+    replay = RawDataReplay(args.raw_data_file, speed=args.speed, restamp=not args.keep_timestamps)
+    replay.replay(socket=args.socket, repeat=args.repeat)
@@ -10,30 +10,33 @@ import collections
 import inspect
 import multiprocessing
 import os
+import queue
+import sys
 import time
 import traceback
 from datetime import datetime
 from collections import OrderedDict
 from contextlib import contextmanager
 from copy import deepcopy
-from threading import Lock
+from threading import Lock, Thread
 
 import numpy as np
 import tables as tb
 import yaml
 import zmq
-from online_monitor.utils import utils as ou
 
 from tjmonopix2 import utils
 from tjmonopix2.analysis import analysis_utils as au
+from tjmonopix2.analysis.analysis_utils import COMPRESSION_PROFILES, FILTER_RAW_DATA
 from tjmonopix2.system import fifo_readout, logger
 from tjmonopix2.system.bdaq53 import BDAQ53
 from tjmonopix2.system.fifo_readout import FifoReadout
 from tjmonopix2.system.mio3 import MIO3
+from tjmonopix2.system.profiler import Profiler
+from tjmonopix2.system.sim_daq import SimDaq
 from tjmonopix2.system.tjmonopix2 import TJMonoPix2
 
-# Compression for data files
-FILTER_RAW_DATA = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
+# Compression for data files, raw data compression profiles are defined with the analysis
 FILTER_TABLES = tb.Filters(complib='zlib', complevel=5, fletcher32=False)
 # Default locations
 PROJECT_FOLDER = os.path.join(os.path.dirname(__file__), '..')
@@ -49,7 +52,7 @@ def fill_dict_from_conf_table(table):
     return conf
 
 
-def send_data(socket, data, scan_param_id, name='ReadoutData'):
+def send_data(socket, data, scan_param_id, name='ReadoutData', telemetry=None):
     '''Sends the data of every read out (raw data and meta data)
 
         via ZeroMQ to a specified socket.
@@ -63,6 +66,9 @@ def send_data(socket, data, scan_param_id, name='ReadoutData'):
         error=data[3],  # int
         scan_param_id=scan_param_id
     )
+    if telemetry is not None:
+        data_meta_data['telemetry'] = telemetry  # dict of readout performance metrics
+    from online_monitor.utils import utils as ou  # imported on first use, only needed with online monitor
     try:
         data_ser = ou.simple_enc(data[0], meta=data_meta_data)
         socket.send(data_ser, flags=zmq.NOBLOCK)
@@ -147,6 +153,222 @@ class ChipContainer:
         return 'ChipContainer for %s (%s) of %s with data at %s' % (self.name, self.chip_settings['chip_sn'], self.module_settings['name'], self.output_dir)
 
 
+class RawDataWriter(object):
+    '''
+        Writes raw data and meta data of the readouts to the h5 files in a seperate thread.
+
+        Pending readouts for the same file are written in one go: the raw data is collected in a
+        preallocated buffer and appended to the raw data array at once, the meta data with one table append.
+        Data is also send to the socket of the chip if defined.
+    '''
+
+    def __init__(self, errback=None, maxsize=1000, max_batch_words=2 ** 22, profiler=None):
+        self.errback = errback
+        self.profiler = profiler or Profiler()
+        self.max_batch_words = max_batch_words
+        self._queue = queue.Queue(maxsize=maxsize)  # blocks the caller if writing falls behind
+        self._buffer = np.empty(2 ** 16, dtype=np.uint32)
+        self._thread = None
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running:
+            return
+        self._thread = Thread(target=self._worker, name='WriterThread')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, raw_data_earray, meta_data_table, socket, data_tuple, scan_param_id, telemetry=None):
+        ''' Queue one readout for writing '''
+        self._queue.put((raw_data_earray, meta_data_table, socket, data_tuple, scan_param_id, telemetry))
+
+    def flush(self):
+        ''' Block until all queued readouts are written '''
+        self._queue.join()
+
+    def stop(self):
+        if not self.is_running:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _get_items(self):
+        ''' Pending readouts, blocks until at least one readout is available. A None (stop) ends the list. '''
+        items = [self._queue.get()]
+        n_words = 0
+        while items[-1] is not None and n_words < self.max_batch_words:
+            n_words += items[-1][3][0].shape[0]
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _worker(self):
+        stop = False
+        while not stop:
+            items = self._get_items()
+            stop = items[-1] is None
+            batch = []  # consecutive readouts for the same file
+            for item in items:
+                if item is None:
+                    break
+                if batch and item[0] is not batch[0][0]:
+                    self._write_batch(batch)
+                    batch = []
+                batch.append(item)
+            if batch:
+                self._write_batch(batch)
+            for _ in items:
+                self._queue.task_done()
+
+    def _write_batch(self, batch):
+        try:
+            self._write(batch)
+        except Exception:
+            if self.errback:
+                self.errback(sys.exc_info())
+            else:
+                raise
+
+    def _write(self, batch):
+        raw_data_earray, meta_data_table = batch[0][0], batch[0][1]
+        lengths = [item[3][0].shape[0] for item in batch]
+        n_words = sum(lengths)
+
+        if len(batch) == 1:
+            raw_data = batch[0][3][0]
+        else:
+            if self._buffer.shape[0] < n_words:
+                self._buffer = np.empty(1 << (n_words - 1).bit_length(), dtype=np.uint32)
+            raw_data = self._buffer[:n_words]
+            index = 0
+            for item, length in zip(batch, lengths):
+                raw_data[index:index + length] = item[3][0]
+                index += length
+
+        meta_data = np.zeros(len(batch), dtype=meta_data_table.dtype)
+        index_stop = raw_data_earray.nrows + np.cumsum(lengths)
+        meta_data['index_stop'] = index_stop
+        meta_data['index_start'] = index_stop - lengths
+        meta_data['data_length'] = lengths
+        meta_data['timestamp_start'] = [item[3][1] for item in batch]
+        meta_data['timestamp_stop'] = [item[3][2] for item in batch]
+        meta_data['error'] = [item[3][3] for item in batch]
+        meta_data['scan_param_id'] = [item[4] for item in batch]
+
+        with self.profiler.phase('hdf5_append', 'io', chip='', scan_param_id=batch[-1][4]):
+            if n_words:
+                raw_data_earray.append(raw_data)
+                raw_data_earray.flush()
+            meta_data_table.append(meta_data)
+            meta_data_table.flush()
+
+        for _, _, socket, data_tuple, scan_param_id, telemetry in batch:
+            if socket:
+                send_data(socket, data=data_tuple, scan_param_id=scan_param_id, telemetry=telemetry)
+
+
+class MmapRawDataWriter(object):
+    '''
+        Writes the raw data of the readouts uncompressed into preallocated memory-mapped files next to the h5 files.
+
+        Capture mode for highest data rates: raw data words and a small index (the meta data rows) are copied into
+        the memory maps without compression and flushing. When stopped, the captured data is converted into the
+        standard raw_data and meta_data nodes of the h5 files and the capture files are deleted.
+    '''
+
+    def __init__(self, errback=None, capture_words=2 ** 28, capture_readouts=2 ** 16, chunk_words=2 ** 24, profiler=None):
+        self.errback = errback
+        self.profiler = profiler or Profiler()
+        self.capture_words = capture_words  # preallocated words per file, doubled if exceeded
+        self.capture_readouts = capture_readouts  # preallocated index rows per file, doubled if exceeded
+        self.chunk_words = chunk_words  # words per raw data append during conversion
+        self._captures = OrderedDict()  # raw data earray -> [meta data table, raw data memmap, index memmap, words, readouts]
+
+    @property
+    def is_running(self):
+        return False
+
+    def start(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def put(self, raw_data_earray, meta_data_table, socket, data_tuple, scan_param_id, telemetry=None):
+        ''' Copy one readout into the capture files of the h5 file '''
+        try:
+            capture = self._captures.get(raw_data_earray)
+            if capture is None:
+                capture = self._create_capture(raw_data_earray, meta_data_table)
+            _, raw_data, index, n_words, n_readouts = capture
+            data = data_tuple[0]
+            len_raw_data = data.shape[0]
+            if n_words + len_raw_data > raw_data.shape[0]:
+                raw_data = capture[1] = self._resize(raw_data, max(2 * raw_data.shape[0], n_words + len_raw_data))
+            if n_readouts >= index.shape[0]:
+                index = capture[2] = self._resize(index, 2 * index.shape[0])
+            raw_data[n_words:n_words + len_raw_data] = data
+            row = index[n_readouts]
+            row['index_start'] = n_words
+            row['index_stop'] = n_words + len_raw_data
+            row['data_length'] = len_raw_data
+            row['timestamp_start'] = data_tuple[1]
+            row['timestamp_stop'] = data_tuple[2]
+            row['error'] = data_tuple[3]
+            row['scan_param_id'] = scan_param_id
+            capture[3] = n_words + len_raw_data
+            capture[4] = n_readouts + 1
+        except Exception:
+            if self.errback:
+                self.errback(sys.exc_info())
+            else:
+                raise
+        if socket:
+            send_data(socket, data=data_tuple, scan_param_id=scan_param_id, telemetry=telemetry)
+
+    def stop(self):
+        ''' Convert the captured data to the h5 files '''
+        while self._captures:
+            raw_data_earray, capture = self._captures.popitem(last=False)
+            filenames = (capture[1].filename, capture[2].filename)
+            self._convert(raw_data_earray, *capture)
+            del capture  # release memory maps before deleting the files
+            for filename in filenames:
+                os.remove(filename)
+
+    def _create_capture(self, raw_data_earray, meta_data_table):
+        basename = os.path.splitext(raw_data_earray._v_file.filename)[0]
+        raw_data = np.memmap(basename + '_capture_raw.bin', dtype=np.uint32, mode='w+', shape=(self.capture_words, ))
+        index = np.memmap(basename + '_capture_index.bin', dtype=meta_data_table.dtype, mode='w+', shape=(self.capture_readouts, ))
+        capture = self._captures[raw_data_earray] = [meta_data_table, raw_data, index, 0, 0]
+        return capture
+
+    def _resize(self, array, size):
+        ''' Enlarge memory-mapped file '''
+        array.flush()
+        filename, dtype = array.filename, array.dtype
+        del array
+        return np.memmap(filename, dtype=dtype, mode='r+', shape=(size, ))
+
+    def _convert(self, raw_data_earray, meta_data_table, raw_data, index, n_words, n_readouts):
+        with self.profiler.phase('hdf5_append', 'io', chip='', scan_param_id=-1):
+            index_offset = raw_data_earray.nrows
+            for start in range(0, n_words, self.chunk_words):
+                raw_data_earray.append(raw_data[start:min(start + self.chunk_words, n_words)])
+            raw_data_earray.flush()
+            meta_data = np.array(index[:n_readouts])
+            meta_data['index_start'] += index_offset
+            meta_data['index_stop'] += index_offset
+            meta_data_table.append(meta_data)
+            meta_data_table.flush()
+
+
 class ScanBase(object):
     '''
         Basic run meta class.
@@ -154,6 +376,7 @@ class ScanBase(object):
     '''
 
     is_parallel_scan = False  # Parallel readout of ExtTrigger-type scans etc.; must be overridden in the derived classes if needed
+    online_histograms = None  # Online histograms of all chips (e.g. ('occupancy', )); must be overridden in the derived classes if needed
 
     def __init__(self, daq_conf=None, bench_config=None, scan_config={}, scan_config_per_chip=None, suffix=''):
         '''
@@ -216,6 +439,9 @@ class ScanBase(object):
 
         # Needed for parallel scans where several readout threads change the chip handles
         self.chip_handle_lock = Lock()
+        self.online_histogramming = None  # online histogramming of all chips, defined during configure if requested
+        self.data_writer = None  # writes the readouts to file, defined during configure
+        self.profiler = Profiler()  # timing of scan phases and chip operations, enabled by the testbench setting 'profile'
 
         # All chips data containers
         self.chips = {}
@@ -225,8 +451,9 @@ class ScanBase(object):
         try:
             self.errors_occured = False
             self._init_environment()
-            self._init_hardware(force)
-            self._init_files()
+            with self.profiler.phase('init'):
+                self._init_hardware(force)
+                self._init_files()
             self.initialized = True
         except Exception as e:
             # if self.periphery:
@@ -241,14 +468,17 @@ class ScanBase(object):
             # Deactivate receiver to prevent recording useless data
             for _ in self.iterate_chips():
                 self._set_receiver_enabled(receiver=self.chip.receiver, enabled=False)
+            if self.online_histograms:
+                self._init_online_histogramming()
             for i, _ in enumerate(self.iterate_chips()):
                 with self._logging_through_handler(self.log_fh):
                     self.log.info('Configuring chip {0}...'.format(self.chip.get_sn()))
                     # Load masks from config
                     self._set_receiver_enabled(receiver=self.chip.receiver, enabled=True)
-                    self._configure_masks()
-                    # Scan dependent configuration step before actual scan can be started (set enable masks etc.)
-                    ret_values[i] = self._configure(**self.scan_config)
+                    with self.profiler.phase('configure'):
+                        self._configure_masks()
+                        # Scan dependent configuration step before actual scan can be started (set enable masks etc.)
+                        ret_values[i] = self._configure(**self.scan_config)
                     # self.periphery.get_module_power(module=self.module_settings['name'], log=True)
                     self._set_receiver_enabled(receiver=self.chip.receiver, enabled=False)
 
@@ -282,7 +512,8 @@ class ScanBase(object):
                 for _ in self.iterate_chips():
                     self._set_receiver_enabled(receiver=self.chip.receiver, enabled=True)
                 self.daq.reset_fifo()
-                self._scan(**self.scan_config)
+                with self.profiler.phase('scan', chip=''):
+                    self._scan(**self.scan_config)
                 for _ in self.iterate_chips():
                     self._set_receiver_enabled(receiver=self.chip.receiver, enabled=False)
             else:
@@ -290,9 +521,12 @@ class ScanBase(object):
                 for i, _ in enumerate(self.iterate_chips()):
                     with self._logging_through_handler(self.log_fh):
                         self._set_receiver_enabled(receiver=self.chip.receiver, enabled=True)
-                        ret_values[i] = self._scan(**self.scan_config)
+                        with self.profiler.phase('scan'):
+                            ret_values[i] = self._scan(**self.scan_config)
                         self._set_receiver_enabled(receiver=self.chip.receiver, enabled=False)
             # Finalize scan
+            self._stop_data_writer()
+            self._close_online_histogramming()
             # Disable tlu module in case it was enabled.
             if self.daq.tlu_module_enabled:
                 self.daq.disable_tlu_module()
@@ -304,6 +538,9 @@ class ScanBase(object):
                 self._add_chip_status()
                 node = self.h5_file.create_group(self.h5_file.root, 'configuration_out', 'Configuration after scan step')
                 self._write_config_h5(self.h5_file, node)
+                self._write_readout_telemetry(self.h5_file, node)
+                if self.profiler.enabled:  # phases up to the end of the scan, analysis and close are only in the trace
+                    self.profiler.write_table(self.h5_file, node, chip=self.chip_settings['chip_sn'])
                 self._store_scan_par_values(self.h5_file)  # store scan params in out node, since it is defined during scan step
                 self.h5_file.close()
 
@@ -326,7 +563,8 @@ class ScanBase(object):
                     # Perform actual analysis
                     self.log.info('Starting analysis for ' + self.name + ' (' + self.chip_settings['chip_sn'] + ')')
                     if self.configuration['bench']['analysis'].get('blocking', True):
-                        ret_values[i] = self._analyze()
+                        with self.profiler.phase('analyze'):
+                            ret_values[i] = self._analyze()
                     else:
                         # Sockets must be closed before process fork, otherwise sockets cannot be closed in
                         # main process. This should be OK, since parallel analysis + redoing a scan is unlikely
@@ -378,14 +616,21 @@ class ScanBase(object):
 
             Free hardware resources and store final config
         '''
-        if self.initialized:
-            self.daq.close()
-            # self.periphery.close()
-            self._close_sockets()
-            self.initialized = False
-        if not self.ana_proc:  # h5 files are closed in ana proc
-            for _ in self.iterate_chips():
-                self._close_h5_file()
+        with self.profiler.phase('close', chip=''):
+            self._stop_data_writer()
+            self._close_online_histogramming()
+            if self.initialized:
+                self.daq.close()
+                # self.periphery.close()
+                self._close_sockets()
+                self.initialized = False
+            if not self.ana_proc:  # h5 files are closed in ana proc
+                for _ in self.iterate_chips():
+                    self._close_h5_file()
+        if self.profiler.enabled and self.profiler.trace:
+            trace_file = os.path.join(self.working_dir, self.run_name + '_trace.json')
+            self.profiler.write_chrome_trace(trace_file)
+            self.log.info('Profiling trace written to %s', trace_file)
         with self._logging_through_handlers():
             if self.errors_occured:
                 self.log.error(self.errors_occured)
@@ -455,11 +700,25 @@ class ScanBase(object):
         '''
         for c in self.chips.values():
             self._set_chip_handles(c)
+            self.profiler.chip = c.chip_settings['chip_sn']
             yield c
+        self.profiler.chip = ''
 
     def n_chips(self):
         return len(self.chips)
 
+    def _init_online_histogramming(self):
+        ''' Start online histogramming workers for all chips, the data is routed by receiver '''
+        from tjmonopix2.analysis import online as oa
+        self._close_online_histogramming()
+        receivers = [c.chip_settings['receiver'] for c in self.chips.values()]
+        self.online_histogramming = oa.OnlineHistogrammingPool(receivers=receivers, outputs=self.online_histograms)
+
+    def _close_online_histogramming(self):
+        if self.online_histogramming is not None:
+            self.online_histogramming.close()
+            self.online_histogramming = None
+
     def wait_for_analysis(self):
         ''' Block exction until analysis is finished '''
         if self.ana_proc:
@@ -509,6 +768,11 @@ class ScanBase(object):
         else:
             self.working_dir = os.path.join(os.getcwd(), "output_data")
 
+        general_config = self.configuration['bench']['general']
+        self.profiler.enabled = general_config.get('profile', False)
+        self.profiler.trace = general_config.get('profile_trace', False)
+        self.profiler.reset()
+
         self._create_chip_container(self.scan_config_par, self.scan_config_per_chip_par)  # fill self.chips with chip container objects from testbench and parameters
 
         # Instantiate periphery and RO hardware (append log to all chip log files)
@@ -521,16 +785,17 @@ class ScanBase(object):
                     readout_system = 'bdaq53'
                 if readout_system == "mio3":
                     self.daq = MIO3(conf=self.daq_conf_par, bench_config=self.configuration['bench'])
+                elif readout_system == "simulation":
+                    self.daq = SimDaq(conf=self.daq_conf_par, bench_config=self.configuration['bench'])
                 else:
                     self.daq = BDAQ53(conf=self.daq_conf_par, bench_config=self.configuration['bench'])
 
         # Instantiate TJ-Monopix2 chip
         for _ in self.iterate_chips():
             with self._logging_through_handler(self.log_fh):
-                if self.chip:  # create chip object only once
-                    continue
-                else:
+                if not self.chip:  # create chip object only once
                     self.chip = TJMonoPix2(self.daq, chip_sn=self.chip_settings['chip_sn'], chip_id=self.chip_settings['chip_id'], receiver=self.chip_settings['receiver'], config=self.chip_conf)
+                self.chip.profiler = self.profiler
 
     def _init_files(self):
         for _ in self.iterate_chips():
@@ -541,7 +806,7 @@ class ScanBase(object):
 
             # Create data nodes
             self.raw_data_earray = self.h5_file.create_earray(self.h5_file.root, name='raw_data', atom=tb.UIntAtom(),
-                                                              shape=(0,), title='raw_data', filters=FILTER_RAW_DATA)
+                                                              shape=(0,), title='raw_data', filters=self._get_raw_data_filters())
             self.meta_data_table = self.h5_file.create_table(self.h5_file.root, name='meta_data', description=MetaTable,
                                                              title='meta_data', filters=FILTER_TABLES)
             # self.trigger_table = self.h5_file.create_table(self.h5_file.root, name='trigger_table', description=MapTable,
@@ -990,8 +1255,36 @@ class ScanBase(object):
 
         self.chip.masks.update(force=True)  # write all masks to chip
 
+    def _write_readout_telemetry(self, h5_file, node):
+        ''' Write readout performance metrics of the run to the scan node of the provided node of a h5 file '''
+        telemetry_table = h5_file.create_table(node.scan, name='readout_telemetry', title='Readout telemetry', description=RunConfigTable)
+        for attr, val in self.fifo_readout.get_telemetry().items():
+            row = telemetry_table.row
+            row['attribute'] = attr
+            row['value'] = str(val)
+            row.append()
+        telemetry_table.flush()
+
+    def _get_raw_data_filters(self):
+        ''' Returns the filters of the compression profile selected in the test bench and sets the blosc threads '''
+        general_config = self.configuration['bench']['general']
+        profile = general_config.get('compression', 'balanced')
+        if profile not in COMPRESSION_PROFILES:
+            raise ValueError('Unknown compression profile %s, use one of %s' % (profile, ', '.join(COMPRESSION_PROFILES)))
+        tb.set_blosc_max_threads(general_config.get('compression_threads', min(4, os.cpu_count() or 1)))
+        return COMPRESSION_PROFILES[profile]
+
     def _configure_fifo_readout(self):
-        self.fifo_readout = FifoReadout(self.daq)
+        general_config = self.configuration['bench']['general']
+        self._stop_data_writer()
+        if general_config.get('capture_mode', 'hdf5') == 'mmap':  # uncompressed capture, converted to h5 after the scan
+            self.data_writer = MmapRawDataWriter(errback=self.handle_err, capture_words=int(general_config.get('capture_size_mb', 1024) * 2 ** 18), profiler=self.profiler)
+        else:
+            self.data_writer = RawDataWriter(errback=self.handle_err, profiler=self.profiler)
+        self.fifo_readout = FifoReadout(self.daq,
+                                        queue_size=general_config.get('readout_queue_size', 10000),
+                                        queue_max_bytes=int(general_config.get('readout_queue_max_mb', 1024) * 2 ** 20),
+                                        overflow_policy=general_config.get('readout_overflow_policy', 'block'))
         self._first_read = False
         # for receiver in self.daq.receivers:
         #     if self.daq.board_version != 'SIMULATION':  # Causes a timing issue in simulation
@@ -1073,6 +1366,7 @@ class ScanBase(object):
     def readout(self, scan_param_id=0, timeout=10.0, **kwargs):
 
         self.scan_param_id = scan_param_id
+        self.profiler.scan_param_id = scan_param_id
 
         callback = kwargs.pop('callback', self.handle_data)
         errback = kwargs.pop('errback', self.handle_err)
@@ -1082,14 +1376,17 @@ class ScanBase(object):
         if kwargs:
             self.store_scan_par_values(scan_param_id, **kwargs)
 
-        self.start_readout(callback=callback, clear_buffer=clear_buffer, fill_buffer=fill_buffer, errback=errback, **kwargs)
-        try:
-            yield
-        finally:
-            if self.daq.board_version == 'SIMULATION':
-                for _ in range(100):
-                    self.daq.rx_channels[self.chip.receiver].is_done()
-            self.stop_readout(timeout=timeout)
+        with self.profiler.phase('readout', 'readout'):
+            self.start_readout(callback=callback, clear_buffer=clear_buffer, fill_buffer=fill_buffer, errback=errback, **kwargs)
+            try:
+                yield
+            finally:
+                if self.daq.board_version == 'SIMULATION':
+                    for _ in range(100):
+                        self.daq.rx_channels[self.chip.receiver].is_done()
+                with self.profiler.phase('fifo_wait', 'readout'):
+                    self.stop_readout(timeout=timeout)
+                self.profiler.scan_param_id = -1
 
     def start_readout(self, **kwargs):
         # Pop parameters for fifo_readout.start
@@ -1100,36 +1397,27 @@ class ScanBase(object):
         errback = kwargs.pop('errback', self.handle_err)
         no_data_timeout = kwargs.pop('no_data_timeout', None)
 
+        self.data_writer.start()
         self.fifo_readout.start(reset_sram_fifo=reset_sram_fifo, fill_buffer=fill_buffer, clear_buffer=clear_buffer,
                                 callback=callback, errback=errback, no_data_timeout=no_data_timeout)
 
     def stop_readout(self, timeout=10.0):
         self.fifo_readout.stop(timeout=timeout)
+        self.data_writer.flush()  # all data of this readout is written to file
+
+    def _stop_data_writer(self):
+        ''' Stop writer thread or convert captured data to the h5 files '''
+        if self.data_writer is not None:
+            self.data_writer.stop()
 
     def handle_data(self, data_tuple):
         '''
             Handling of the data.
+
+            The data is queued and written to the h5 file (and send to the socket) by the data writer thread.
         '''
-        total_words = self.raw_data_earray.nrows
-
-        self.raw_data_earray.append(data_tuple[0])
-        self.raw_data_earray.flush()
-
-        len_raw_data = data_tuple[0].shape[0]
-        self.meta_data_table.row['timestamp_start'] = data_tuple[1]
-        self.meta_data_table.row['timestamp_stop'] = data_tuple[2]
-        self.meta_data_table.row['error'] = data_tuple[3]
-        self.meta_data_table.row['data_length'] = len_raw_data
-        self.meta_data_table.row['index_start'] = total_words
-        total_words += len_raw_data
-        self.meta_data_table.row['index_stop'] = total_words
-        self.meta_data_table.row['scan_param_id'] = self.scan_param_id
-
-        self.meta_data_table.row.append()
-        self.meta_data_table.flush()
-
-        if self.socket:
-            send_data(self.socket, data=data_tuple, scan_param_id=self.scan_param_id)
+        telemetry = self.fifo_readout.get_telemetry() if self.socket else None
+        self.data_writer.put(self.raw_data_earray, self.meta_data_table, self.socket, data_tuple, self.scan_param_id, telemetry=telemetry)
 
     def handle_err(self, exc):
         ''' Handle errors when readout is started '''
@@ -0,0 +1,582 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Software readout system: a stand-in for the BDAQ53 / MIO3 boards that needs no hardware.
+
+    The command stream sent by TJMonoPix2 is decoded into a model of the chip configuration
+    (registers, pixel portal, injection and readout enables). Register reads are answered,
+    injections produce hits following an S-curve per pixel and noise hits, particle hits
+    and TLU words are produced at configurable rates. Select it in the testbench with
+    readout_system: simulation, the chip model is configured in the simulation section:
+
+        simulation:
+          threshold: 25.0  # mean threshold in injection DAC units (VH - VL)
+          noise_rate: 0.01  # noise hits per enabled pixel and second
+          hit_rate: 1000  # particles per second
+          trigger_rate: 1000  # particles per second with TLU word while the TLU module is enabled
+'''
+
+import math
+import os
+import threading
+import time
+
+import numpy as np
+import yaml
+from numba import njit
+
+from tjmonopix2.system import logger
+from tjmonopix2.system.tjmonopix2 import RegisterObject, TJMonoPix2
+
+DEFAULT_SETTINGS = {
+    'board_version': 'bdaq53',  # Use 'SIMULATION' to skip the full register and mask writes like for the RTL simulation
+    'seed': 0,
+    'cmd_mem_size': 8192,  # Command memory size in bytes
+    'fifo_depth': 2 ** 23,  # FIFO depth in 32-bit words, data exceeding it is lost
+    'threshold': 25.0,  # Mean pixel threshold in injection DAC units (VH - VL) at TDAC = 4
+    'threshold_dispersion': 2.0,
+    'tdac_step': 1.5,  # Threshold change per TDAC step
+    'noise': 1.0,  # Mean pixel noise (S-curve sigma) in injection DAC units
+    'tot_offset': 10.0,  # ToT at threshold in 25 ns units
+    'tot_slope': 0.5,  # ToT increase per injection DAC unit above threshold
+    'noise_rate': 0.0,  # Noise hits per enabled pixel and second
+    'hit_rate': 0.0,  # Particles per second
+    'trigger_rate': 0.0,  # Particles per second with TLU word, only while the TLU module is enabled
+    'cluster_size': 2.0,  # Mean number of pixels per particle
+    'temperature': 25.0
+}
+
+
+@njit(cache=True)
+def _seed(seed):
+    np.random.seed(seed)
+
+
+@njit(cache=True)
+def _execute_commands(data, start, symbol_values, regs, pixels, replies, n_replies, portal_address, select_address, config_addresses):
+    '''
+        Decode the command stream from start on, apply register writes to regs and pixels
+        and store the register read replies (address, value) in replies.
+
+        Stops after a CAL command, returns the index to continue from, the number of replies,
+        whether the pixel configuration (portal or registers in the config_addresses range) changed
+        and whether a CAL command was found.
+    '''
+    idx = start
+    changed = False
+    while idx < len(data):
+        cmd = data[idx]
+        if cmd == 0x81 and idx + 1 < len(data) and data[idx + 1] == 0x7E:  # sync
+            idx += 2
+        elif cmd == 0x66 and idx + 7 < len(data):  # register write
+            w0 = symbol_values[data[idx + 2]]
+            w1 = symbol_values[data[idx + 3]]
+            w2 = symbol_values[data[idx + 4]]
+            w3 = symbol_values[data[idx + 5]]
+            w4 = symbol_values[data[idx + 6]]
+            w5 = symbol_values[data[idx + 7]]
+            if min(min(w0, w1), min(min(w2, w3), min(w4, w5))) < 0:
+                idx += 1
+                continue
+            address = (w0 << 5) | w1
+            value = ((w2 << 11) | (w3 << 6) | (w4 << 1) | (w5 >> 4)) & 0xFFFF
+            if address < len(regs):
+                regs[address] = value
+            if config_addresses[0] <= address < config_addresses[1]:
+                changed = True
+            elif address == portal_address:
+                changed = True
+                colgroup = (regs[select_address] >> 9) & 0x7F
+                row = regs[select_address] & 0x1FF
+                for i in range(4):
+                    pixels[colgroup * 4 + i, row] = (value >> (4 * i)) & 0xF
+            idx += 8
+        elif cmd == 0x65 and idx + 3 < len(data):  # register read
+            w0 = symbol_values[data[idx + 2]]
+            w1 = symbol_values[data[idx + 3]]
+            if min(w0, w1) >= 0:
+                address = (w0 << 5) | w1
+                replies[n_replies, 0] = address
+                replies[n_replies, 1] = regs[address] if address < len(regs) else 0
+                n_replies += 1
+            idx += 4
+        elif cmd == 0x63 and idx + 5 < len(data):  # calibration injection
+            return idx + 6, n_replies, changed, True
+        elif cmd == 0x5A or cmd == 0x5C:  # clear, global pulse
+            idx += 2
+        else:
+            idx += 1
+    return idx, n_replies, changed, False
+
+
+@njit(cache=True)
+def _inject(thresholds, noise, charge, repetitions, tot_offset, tot_slope):
+    '''
+        Injection of the given pixels: every pixel fires with the probability of its S-curve
+        at the injected charge. One frame per injection.
+
+        Returns the index of the firing pixels, their ToT and the end index of each frame.
+    '''
+    n = len(thresholds)
+    prob = np.empty(n)
+    for i in range(n):
+        prob[i] = 0.5 * math.erfc((thresholds[i] - charge) / (math.sqrt(2.) * noise[i]))
+    hit_index = np.empty(repetitions * n, dtype=np.int64)
+    tot = np.empty(repetitions * n, dtype=np.uint8)
+    frame_ends = np.empty(repetitions, dtype=np.int64)
+    n_hits = 0
+    for rep in range(repetitions):
+        for i in range(n):
+            if np.random.random() < prob[i]:
+                hit_index[n_hits] = i
+                tot[n_hits] = min(max(int(tot_offset + tot_slope * (charge - thresholds[i]) + np.random.normal()), 1), 127)
+                n_hits += 1
+        frame_ends[rep] = n_hits
+    return hit_index[:n_hits], tot[:n_hits], frame_ends
+
+
+@njit(cache=True)
+def _encode_frames(cols, rows, le, te, frame_ends, triggers):
+    '''
+        Raw data words of hit frames (SOF, 4 symbols per hit, EOF), every frame is padded with idles
+        to full words. Frames with triggers[i] >= 0 are preceded by a TLU word with this trigger number.
+    '''
+    n_frames = len(frame_ends)
+    words = np.empty(n_frames * 3 + (len(cols) * 4 + 2) // 3, dtype=np.uint32)
+    symbols = np.empty(len(cols) * 4 + 5, dtype=np.uint32)
+    n_words = 0
+    start = 0
+    for frame in range(n_frames):
+        if triggers[frame] >= 0:
+            words[n_words] = 0x80000000 | (triggers[frame] & 0x7FFFFFFF)
+            n_words += 1
+        symbols[0] = 0x1bc  # SOF
+        n_symbols = 1
+        for i in range(start, frame_ends[frame]):
+            le_gray = le[i] ^ (le[i] >> 1)
+            te_gray = te[i] ^ (te[i] >> 1)
+            symbols[n_symbols] = cols[i] >> 1
+            symbols[n_symbols + 1] = ((le_gray << 1) | (te_gray >> 6)) & 0xFF
+            symbols[n_symbols + 2] = ((te_gray & 0x3F) << 2) | ((cols[i] & 0x1) << 1) | (rows[i] >> 8)
+            symbols[n_symbols + 3] = rows[i] & 0xFF
+            n_symbols += 4
+        symbols[n_symbols] = 0x17c  # EOF
+        n_symbols += 1
+        while n_symbols % 3:
+            symbols[n_symbols] = 0x13c  # IDLE
+            n_symbols += 1
+        for k in range(0, n_symbols, 3):
+            words[n_words] = 0x40000000 | (symbols[k] << 18) | (symbols[k + 1] << 9) | symbols[k + 2]
+            n_words += 1
+        start = frame_ends[frame]
+    return words[:n_words]
+
+
+class SimChip(object):
+    ''' Model of the chip configuration with the analog front end reduced to a threshold and noise per pixel '''
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.registers = RegisterObject(None, 'registers.yaml')
+        self.addresses = {name: self.registers[name]['address'] for name in ('PIXEL_PORTAL', 'ROW_SELECT', 'VH', 'EN_INJ_COL', 'EN_INJ_ROW', 'EN_RO_CONF')}
+        # Injection enables and double column readout enables
+        self.config_addresses = np.array([self.addresses['EN_INJ_COL'], self.addresses['EN_RO_CONF'] + 16])
+        self.symbol_values = np.full(256, -1, dtype=np.int16)
+        self.symbol_values[TJMonoPix2.cmd_symbols] = np.arange(len(TJMonoPix2.cmd_symbols))
+
+        self.rng = np.random.default_rng(settings['seed'])
+        _seed(settings['seed'])
+        self.threshold_map = settings['threshold'] + settings['threshold_dispersion'] * self.rng.standard_normal((512, 512))
+        self.noise_map = np.clip(settings['noise'] * (1. + 0.1 * self.rng.standard_normal((512, 512))), 0.05, None)
+        self.reset()
+
+    def reset(self):
+        ''' Power on state: default register values, all pixels disabled '''
+        self.regs = np.zeros(max(self.registers.words) + 1, dtype=np.uint16)
+        for address, word in self.registers.words.items():
+            self.regs[address] = word
+        self.pixels = np.zeros((512, 512), dtype=np.uint8)  # 4-bit pixel portal configuration, 0 = disabled, else TDAC
+        self._enabled = None
+        self._injected = None
+
+    def _get_bits(self, address, n_bits):
+        return np.unpackbits(self.regs[address:address + n_bits // 16].view(np.uint8), bitorder='little').astype(bool)
+
+    def get_enabled_pixels(self):
+        ''' Flat indices of all enabled pixels in double columns with enabled readout '''
+        if self._enabled is None:
+            readout = np.repeat(self._get_bits(self.addresses['EN_RO_CONF'], 256), 2)
+            self._enabled = np.flatnonzero((self.pixels != 0) & readout[:, np.newaxis])
+        return self._enabled
+
+    def get_injected_pixels(self):
+        ''' Flat indices of all enabled pixels selected by the injection column and row enables '''
+        if self._injected is None:
+            enabled = self.get_enabled_pixels()
+            cols, rows = np.divmod(enabled, 512)
+            sel = self._get_bits(self.addresses['EN_INJ_COL'], 512)[cols] & self._get_bits(self.addresses['EN_INJ_ROW'], 512)[rows]
+            self._injected = enabled[sel]
+        return self._injected
+
+    def get_thresholds(self, pixels):
+        return self.threshold_map.flat[pixels] + (self.pixels.flat[pixels].astype(float) - 4) * self.settings['tdac_step']
+
+    def execute(self, data, repetitions=1):
+        ''' Execute a command stream, returns the raw data words of the chip response '''
+        data = np.asarray(data, dtype=np.uint8)
+        replies = np.empty((len(data) // 4 + 1, 2), dtype=np.uint16)
+        n_replies = 0
+        words = []
+        idx = 0
+        while idx < len(data):
+            idx, n_replies, changed, cal = _execute_commands(data, idx, self.symbol_values, self.regs, self.pixels, replies, n_replies,
+                                                             self.addresses['PIXEL_PORTAL'], self.addresses['ROW_SELECT'], self.config_addresses)
+            if changed:
+                self._enabled = self._injected = None
+            if cal:
+                words.append(self.inject(repetitions))
+        if n_replies:
+            words.append(self._encode_replies(replies[:n_replies]))
+        return words
+
+    def inject(self, repetitions=1):
+        pixels = self.get_injected_pixels()
+        vh = self.regs[self.addresses['VH']] >> 8
+        vl = self.regs[self.addresses['VH']] & 0xFF
+        hit_index, tot, frame_ends = _inject(self.get_thresholds(pixels), self.noise_map.flat[pixels], float(vh) - float(vl), repetitions,
+                                             self.settings['tot_offset'], self.settings['tot_slope'])
+        return self._encode(pixels[hit_index], tot, frame_ends)
+
+    def get_random_hits(self, n_hits=0, n_particles=0, triggers=None):
+        ''' Raw data words of n_hits noise hits and n_particles particle clusters, one frame each '''
+        enabled = self.get_enabled_pixels()
+        if len(enabled) == 0:
+            return np.empty(0, dtype=np.uint32)
+        noise = self.rng.choice(enabled, size=n_hits)
+        noise_tot = self.rng.integers(1, 8, size=n_hits)
+
+        sizes = 1 + self.rng.poisson(max(self.settings['cluster_size'] - 1., 0.), size=n_particles)
+        seeds = np.repeat(self.rng.choice(enabled, size=n_particles), sizes)
+        cols = np.clip(seeds // 512 + self.rng.integers(-1, 2, size=len(seeds)), 0, 511)
+        rows = np.clip(seeds % 512 + self.rng.integers(-1, 2, size=len(seeds)), 0, 511)
+        cols[np.cumsum(sizes) - sizes] = seeds[np.cumsum(sizes) - sizes] // 512  # seed pixel first
+        rows[np.cumsum(sizes) - sizes] = seeds[np.cumsum(sizes) - sizes] % 512
+        particles = cols * 512 + rows
+        particle_tot = self.rng.integers(1, 64, size=len(particles))
+
+        frame_ends = np.concatenate((np.arange(1, n_hits + 1), n_hits + np.cumsum(sizes)))
+        if triggers is None:
+            triggers = np.full(n_particles, -1)
+        triggers = np.concatenate((np.full(n_hits, -1), triggers))
+        return self._encode(np.concatenate((noise, particles)), np.concatenate((noise_tot, particle_tot)), frame_ends, triggers)
+
+    def _encode(self, pixels, tot, frame_ends, triggers=None):
+        cols, rows = np.divmod(pixels.astype(np.int64), 512)
+        le = self.rng.integers(0, 128, size=len(pixels))
+        te = (le + tot) & 0x7F
+        if triggers is None:
+            triggers = np.full(len(frame_ends), -1)
+        return _encode_frames(cols, rows, le, te, frame_ends.astype(np.int64), triggers.astype(np.int64))
+
+    def _encode_replies(self, replies):
+        symbols = np.empty((len(replies), 5), dtype=np.uint32)
+        symbols[:, 0] = 0x1fc
+        symbols[:, 1] = replies[:, 0] & 0xFF
+        symbols[:, 2] = replies[:, 1] >> 8
+        symbols[:, 3] = replies[:, 1] & 0xFF
+        symbols[:, 4] = 0x15c
+        symbols = np.concatenate((symbols.ravel(), np.full(-symbols.size % 3, 0x13c, dtype=np.uint32))).reshape(-1, 3)
+        return 0x40000000 | (symbols[:, 0] << 18) | (symbols[:, 1] << 9) | symbols[:, 2]
+
+
+class SimFifo(object):
+    ''' SRAM FIFO, filled by the chip response and the hits generated at the configured rates '''
+
+    def __init__(self, daq):
+        self.daq = daq
+        self.data = []
+        self.size = 0  # in words
+        self._last_time = time.perf_counter()
+        self._lock = threading.Lock()  # chip replies are appended by the main thread, data is read by the readout thread
+
+    def __getitem__(self, name):
+        if name == 'FIFO_SIZE':
+            return self.get_FIFO_SIZE()
+        if name == 'RESET':
+            return self.reset()
+        raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        if name == 'RESET':
+            self.reset()
+        else:
+            raise KeyError(name)
+
+    def reset(self):
+        with self._lock:
+            self.data = []
+            self.size = 0
+            self._last_time = time.perf_counter()
+
+    def append(self, words):
+        with self._lock:
+            self._append(words)
+
+    def _append(self, words):
+        if not self.daq.receiving:
+            return
+        n_free = self.daq.settings['fifo_depth'] - self.size
+        if len(words) > n_free:
+            for rx in self.daq.rx_channels.values():
+                rx.lost_data += len(words) - n_free
+            words = words[:n_free]
+        if len(words):
+            self.data.append(words)
+            self.size += len(words)
+
+    def _generate(self):
+        ''' Noise and particle hits since the last call, the lock has to be held '''
+        now = time.perf_counter()
+        dt, self._last_time = min(now - self._last_time, 1.), now
+        if not self.daq.receiving:
+            return
+        settings = self.daq.settings
+        n_hits = self.daq.chip.rng.poisson(settings['noise_rate'] * len(self.daq.chip.get_enabled_pixels()) * dt)
+        n_particles = self.daq.chip.rng.poisson(settings['hit_rate'] * dt)
+        triggers = np.full(n_particles, -1)
+        if self.daq.tlu_module_enabled:
+            n_triggers = self.daq.chip.rng.poisson(settings['trigger_rate'] * dt)
+            if self.daq['tlu']['MAX_TRIGGERS']:
+                n_triggers = max(0, min(n_triggers, self.daq['tlu']['MAX_TRIGGERS'] - self.daq['tlu']['TRIGGER_COUNTER']))
+            triggers = np.concatenate((triggers, self.daq['tlu']['TRIGGER_COUNTER'] + np.arange(n_triggers)))
+            self.daq['tlu']['TRIGGER_COUNTER'] += n_triggers
+            n_particles += n_triggers
+        if n_hits or n_particles:
+            self._append(self.daq.chip.get_random_hits(n_hits, n_particles, triggers))
+
+    def update(self):
+        ''' Generate the hits since the last call '''
+        with self._lock:
+            self._generate()
+
+    def get_FIFO_SIZE(self):
+        ''' FIFO size in bytes '''
+        with self._lock:
+            self._generate()
+            return self.size * 4
+
+    def get_data(self):
+        with self._lock:
+            self._generate()
+            if not self.data:
+                return np.empty(0, dtype=np.uint32)
+            data = np.concatenate(self.data)
+            self.data = []
+            self.size = 0
+        return data
+
+
+class SimCmd(object):
+    ''' Command encoder, the command memory is executed by the chip model when started '''
+
+    def __init__(self, daq):
+        self.daq = daq
+        self.data = np.empty(0, dtype=np.uint8)
+        self.size = 0
+        self.repetitions = 1
+        self.chip_type = 1
+        self.output_en = True
+
+    def reset(self):
+        self.size = 0
+        self.repetitions = 1
+
+    def get_mem_size(self):
+        return self.daq.settings['cmd_mem_size']
+
+    def set_chip_type(self, value):
+        self.chip_type = value
+
+    def set_output_en(self, value):
+        self.output_en = value
+
+    def set_data(self, data, addr=0):
+        if self.get_mem_size() < len(data):
+            raise ValueError('Size of data (%d bytes) is too big for memory (%d bytes)' % (len(data), self.get_mem_size()))
+        self.data = np.asarray(data, dtype=np.uint8)
+
+    def set_size(self, value):
+        self.size = value
+
+    def get_size(self):
+        return self.size
+
+    def set_repetitions(self, value):
+        self.repetitions = value
+
+    def get_repetitions(self):
+        return self.repetitions
+
+    def is_done(self):
+        return True
+
+    def start(self):
+        if not self.output_en:
+            return
+        for words in self.daq.chip.execute(self.data[:self.size], repetitions=self.repetitions):
+            self.daq['FIFO'].append(words)
+
+
+class SimRx(object):
+    ''' Receiver, always ready and without decoder errors '''
+
+    def __init__(self, name):
+        self.name = name
+        self.registers = {'ENABLE': 1, 'INVERT': 0, 'DATA_DELAY': 0, 'SAMPLING_EDGE': 0, 'NO_8B10B_MODE': 0}
+        self.lost_data = 0
+
+    def __getitem__(self, name):
+        return self.registers[name]
+
+    def __setitem__(self, name, value):
+        self.registers[name] = value
+
+    def init(self):
+        pass
+
+    def reset(self):
+        self.lost_data = 0
+
+    def rx_reset(self):
+        pass
+
+    def set_en(self, value):
+        self.registers['ENABLE'] = int(value)
+
+    def is_done(self):
+        return self.is_ready
+
+    @property
+    def is_ready(self):
+        return True
+
+    def set_invert_rx(self, value):
+        self.registers['INVERT'] = value
+
+    def get_invert_rx(self):
+        return self.registers['INVERT']
+
+    def get_decoder_error_counter(self):
+        return 0
+
+    def get_lost_data_counter(self):
+        return min(self.lost_data, 0xFF)  # 8-bit counter
+
+
+class SimDaq(object):
+    '''
+        Main class for the simulated readout system, provides the interfaces of BDAQ53
+        used by ScanBase, FifoReadout and TJMonoPix2.
+
+        Settings are taken from the simulation section of the testbench configuration
+        and can be overwritten by keyword arguments.
+    '''
+
+    def __init__(self, conf=None, bench_config=None, **kwargs):
+        self.log = logger.setup_main_logger()
+        self.proj_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.configuration = {}
+
+        try:
+            if bench_config is None:
+                bench_config = os.path.join(self.proj_dir, 'testbench.yaml')
+            with open(bench_config) as f:
+                self.configuration = yaml.full_load(f)
+        except TypeError:
+            self.configuration = bench_config
+        except FileNotFoundError:  # no testbench needed for the simulation
+            self.configuration = {}
+
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(self.configuration.get('simulation') or {})
+        self.settings.update(kwargs)
+
+        self.board_version = self.settings['board_version']
+        self.fw_version = 'simulation'
+        self.receivers = ['rx0']
+
+        # Flag indicating of tlu module is enabled.
+        self.tlu_module_enabled = False
+
+        self.chip = SimChip(self.settings)
+        self.rx_channels = {recv: SimRx(recv) for recv in self.receivers}
+        self._modules = {'FIFO': SimFifo(self),
+                         'cmd': SimCmd(self),
+                         'tlu': {'TRIGGER_ENABLE': False, 'TRIGGER_COUNTER': 0, 'MAX_TRIGGERS': 0}}
+
+    def __getitem__(self, name):
+        return self._modules[name]
+
+    @property
+    def receiving(self):
+        return any(rx['ENABLE'] for rx in self.rx_channels.values())
+
+    def init(self, **kwargs):
+        self.chip.reset()
+        self['FIFO'].reset()
+        for rx in self.rx_channels.values():
+            rx.set_en(True)
+        self.log.success('Found board %s running firmware version %s' % (self.board_version, self.fw_version))
+
+    def close(self):
+        pass
+
+    def set_cmd_clk(self, frequency=160.0, force=False):
+        pass
+
+    def set_chip_type(self):
+        self['cmd'].set_chip_type(1)
+
+    def get_temperature_NTC(self, connector=7):
+        return self.settings['temperature']
+
+    def get_temperature_FPGA(self):
+        return self.settings['temperature']
+
+    def enable_tlu_module(self):
+        self['tlu']['TRIGGER_ENABLE'] = True
+        self.tlu_module_enabled = True
+
+    def disable_tlu_module(self):
+        self['tlu']['TRIGGER_ENABLE'] = False
+        self.tlu_module_enabled = False
+
+    def get_trigger_counter(self):
+        self['FIFO'].update()
+        return self['tlu']['TRIGGER_COUNTER']
+
+    def set_trigger_data_delay(self, trigger_data_delay):
+        self['tlu']['TRIGGER_DATA_DELAY'] = trigger_data_delay
+
+    def configure_tlu_module(self, max_triggers=False):
+        self.log.info('Configuring TLU module...')
+        self['tlu'].update(self.configuration.get('TLU') or {})
+        self['tlu']['TRIGGER_COUNTER'] = 0
+        self['tlu']['MAX_TRIGGERS'] = int(max_triggers) if max_triggers else 0
+
+    def get_tlu_erros(self):
+        return (0, 0)
+
+    def configure_tlu_veto_pulse(self, veto_length):
+        pass
+
+    def configure_cmd_loop_start_pulse(self, width=8, delay=140):
+        pass
+
+    def reset_fifo(self):
+        self['FIFO'].reset()
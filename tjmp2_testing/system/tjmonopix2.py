@@ -5,6 +5,7 @@
 # ------------------------------------------------------------
 #
 
+import hashlib
 import os
 import time
 from collections import OrderedDict
@@ -19,7 +20,9 @@ try:
 except ImportError:  # fallback to python parser
     from yaml import SafeLoader  # noqa
 
+from tjmonopix2.analysis.interpreter import gray2bin, split_tjmono_symbols
 from tjmonopix2.system import logger
+from tjmonopix2.system.profiler import Profiler
 
 FLAVOR_COLS = {'MONOPIX2': range(0, 224),
                'MONOPIX2_CASC': range(224, 448),
@@ -33,15 +36,77 @@ def get_flavor(col):
             return fe
 
 
-def gray2bin(gray):
-    b6 = gray & 0x40
-    b5 = (gray & 0x20) ^ (b6 >> 1)
-    b4 = (gray & 0x10) ^ (b5 >> 1)
-    b3 = (gray & 0x08) ^ (b4 >> 1)
-    b2 = (gray & 0x04) ^ (b3 >> 1)
-    b1 = (gray & 0x02) ^ (b2 >> 1)
-    b0 = (gray & 0x01) ^ (b1 >> 1)
-    return b6 + b5 + b4 + b3 + b2 + b1 + b0
+HIT_DTYPE = np.dtype([("col", "<u2"), ("row", "<u2"), ("le", "<u1"), ("te", "<u1"), ("token_id", "<i8")])
+REG_DTYPE = np.dtype([("address", "<u1"), ("value", "<u2")])
+
+
+@njit(cache=True)
+def _interpret_data(rx_data, hit, reg):
+    ''' Decode the symbol stream into hits and register replies, returns their numbers and the number of errors '''
+    h_i = 0
+    r_i = 0
+    errors = 0
+    idx = 0
+    token_id = 0
+    flg = 0
+    while idx < len(rx_data):
+        if rx_data[idx] == 0x1fc:
+            if idx + 4 < len(rx_data) and rx_data[idx + 4] == 0x15c:  # reg data
+                reg[r_i]['address'] = rx_data[idx + 1] & 0x0FF
+                reg[r_i]['value'] = ((rx_data[idx + 2] & 0x0FF) << 8) + (rx_data[idx + 3] & 0x0FF)
+                r_i += 1
+                idx += 5
+            else:  # broken reg data
+                errors += 1
+                idx += 1
+        elif rx_data[idx] == 0x1bc:  # sof
+            idx += 1
+            if flg != 0:  # eof is missing
+                errors += 1
+            flg = 1
+        elif rx_data[idx] == 0x17c:  # eof
+            if flg != 1:  # eof before sof
+                errors += 1
+            flg = 0
+            idx += 1
+            token_id += 1
+        elif rx_data[idx] == 0x13c:  # idle (dummy data)
+            idx += 1
+        else:
+            if flg != 1:  # sof is missing
+                errors += 1
+            if len(rx_data) < idx + 4:  # incomplete data
+                errors += 1
+                break
+            hit[h_i]['token_id'] = token_id
+            hit[h_i]['le'] = gray2bin((rx_data[idx + 1] & 0xFE) >> 1)
+            hit[h_i]['te'] = gray2bin((rx_data[idx + 1] & 0x01) << 6 | ((rx_data[idx + 2] & 0xFC) >> 2))
+            hit[h_i]['row'] = ((rx_data[idx + 2] & 0x1) << 8) | (rx_data[idx + 3] & 0xFF)
+            hit[h_i]['col'] = ((rx_data[idx] & 0xFF) << 1) + ((rx_data[idx + 2] & 0x2) >> 1)
+            idx += 4
+            h_i += 1
+    return h_i, r_i, errors
+
+
+@njit(cache=True)
+def _interpret_no8b10b(rx_data, hit):
+    ''' Decode the symbol stream of the simulation (no 8b10b encoding) into hits, returns their number '''
+    i = 0
+    ii = 0
+    while i < len(rx_data):
+        if rx_data[i] == 0x13C:
+            i += 1
+        elif i + 3 < len(rx_data):
+            hit[ii]['col'] = (rx_data[i] << 1) + ((rx_data[i + 2] & 0x2) >> 1)
+            hit[ii]['row'] = ((rx_data[i + 2] & 0x1) << 9) + rx_data[i + 3]
+            hit[ii]['le'] = gray2bin(rx_data[i + 1] >> 1)
+            hit[ii]['te'] = gray2bin(((rx_data[i + 1] & 0x1) << 6) + ((rx_data[i + 2] & 0xFC) >> 2))
+            hit[ii]['token_id'] = 0
+            ii += 1
+            i += 4
+        else:
+            i += 1
+    return ii
 
 
 @njit(cache=True, fastmath=True)
@@ -75,12 +140,15 @@ class Register(dict):
         self['address'] = address
         self['offset'] = offset
         self['size'] = size
-        self['default'] = eval(default)
-        self['value'] = eval(value)
+        self['default'] = self._assert_value(default)
+        self['value'] = self._assert_value(value)
         self['mode'] = mode
         self['reset'] = reset
         self['description'] = description
 
+        self.bit_mask = (1 << size) - 1
+        self.n_words = (offset + size + 15) // 16  # number of 16-bit addresses the register spans
+
     def __str__(self, *args, **kwargs):
         text = self['name']
         text += ': '
@@ -105,12 +173,12 @@ class Register(dict):
 
     def _assert_value(self, value):
         if isinstance(value, (int, np.integer)):
-            return value
+            return int(value)
         if isinstance(value, str):
-            if value[:2] == '0b':
-                return int(value, 2)
-            if value[:2] == '0x':
-                return int(value, 16)
+            try:
+                return int(value, 0)  # decimal, 0b or 0x
+            except ValueError:
+                pass
         raise ValueError('Invalid value of type {0}: {1}'.format(type(value), value))
 
     def set(self, value):
@@ -118,6 +186,7 @@ class Register(dict):
         if value != self['value']:
             self.changed = True
             self['value'] = value
+            self.chip.registers._update_words(self)
 
     def get(self):
         return self['value']
@@ -127,50 +196,42 @@ class Register(dict):
 
     def write(self, value=None, verify=False, write_ctr=0):
         if value is not None:
-            value = self._assert_value(value)
-            self['value'] = value
+            self.set(value)
         self.log.debug(('Writing value 0b{0:0' + str(self['size']) + 'b} to register {1}').format(self['value'], self['name']))
 
-        if self['size'] <= 16:
-            wr_value = 0x0000
-            for reg in self.chip.registers.get_all_at_address(self['address']):
-                wr_value |= reg['value'] << reg['offset']
-
-            self.chip._write_register(self['address'], wr_value)
-        else:
-            raise RuntimeError("Register size is too big, set with _write_register()")
+        with self.chip.profiler.phase('register_write', 'chip'):
+            self.chip.write_command(self.get_write_command())
+        self.changed = False
 
         if verify:
-            if self.read() != value:
+            if self.read() != self['value']:
                 if write_ctr >= 10:
-                    raise RuntimeError('Could not verify value {0} in register {1}'.format(value, self['name']))
-                self.write(value=value, verify=True, write_ctr=write_ctr + 1)
+                    raise RuntimeError('Could not verify value {0} in register {1}'.format(self['value'], self['name']))
+                self.write(verify=True, write_ctr=write_ctr + 1)
 
     def get_write_command(self, value=None):
+        ''' Write commands of all addresses the register spans, including the other registers at these addresses '''
         if value is not None:
             self.set(value)
 
-        if self['size'] <= 16:
-            wr_value = 0x0000
-            for reg in self.chip.registers.get_all_at_address(self['address']):
-                wr_value |= reg['value'] << reg['offset']
-
-            return self.chip._write_register(self['address'], wr_value, write=False)
-        else:
-            wr_value = eval('0b' + '0' * self['size'])
-            indata = []
-            for i in range(0, self['size'], 16):
-                reg_value = (self['value'] & (0xFF << i)) >> i
-                indata += self.chip._write_register(self['address'] + self['size'] // 16 - 1, reg_value, write=False)
-            return indata
+        indata = []
+        for address in self.get_addresses():
+            indata += self.chip._write_register(address, self.chip.registers.words[address], write=False)
+        return indata
 
     def get_read_command(self):
         return self.chip._read_register(self['address'], write=False)
 
     def read(self):
-        val = self.chip._get_register_value(self['address'])
-        bit_mask = eval('0b' + '1' * self['size']) << self['offset']
-        val = (val & bit_mask) >> self['offset']
+        return self._get_from_words(self.chip._get_register_values(self.get_addresses()))
+
+    def get_addresses(self):
+        return range(self['address'], self['address'] + self.n_words)
+
+    def _get_from_words(self, words):
+        ''' Extract the register value from the words read back (address -> word) and compare to the software value '''
+        val = sum(words[address] << (16 * i) for i, address in enumerate(self.get_addresses()))
+        val = (val >> self['offset']) & self.bit_mask
         if val != self['value'] and self['mode'] == 1 and self['name'] != 'PIX_PORTAL':
             self.log.warning(
                 (
@@ -197,6 +258,8 @@ class RegisterObject(OrderedDict):
 
     def __init__(self, chip, lookup_file=None):
         self.chip = chip
+        self.address_map = {}  # address -> registers at this address
+        self.words = {}  # address -> 16-bit word packed from the values of all registers at this address
         super(RegisterObject, self).__init__()
 
         if lookup_file is None:
@@ -220,55 +283,66 @@ class RegisterObject(OrderedDict):
     def _add(self, name, address, offset, size, default, mode, reset, value=None, description=''):
         if value is None:
             value = default
-        self[name] = Register(chip=self.chip, name=name, address=address, offset=offset, size=size, default=default, mode=mode, reset=reset, value=value, description=description)
+        reg = Register(chip=self.chip, name=name, address=address, offset=offset, size=size, default=default, mode=mode, reset=reset, value=value, description=description)
+        self[name] = reg
+        self.address_map.setdefault(address, []).append(reg)
+        self._update_words(reg)
+
+    def _update_words(self, reg):
+        ''' Update the cached words of all addresses spanned by reg with its current value '''
+        value = reg['value'] << reg['offset']
+        mask = reg.bit_mask << reg['offset']
+        for i in range(reg.n_words):
+            word_mask = (mask >> (16 * i)) & 0xFFFF
+            word = self.words.get(reg['address'] + i, 0)
+            self.words[reg['address'] + i] = (word & ~word_mask) | ((value >> (16 * i)) & word_mask)
 
     def get_all_at_address(self, address):
-        regs = []
-        for reg in self.values():
-            if reg['address'] is address:
-                regs.append(reg)
-        if len(regs) > 0:
-            return regs
-        raise ValueError('No register found with address {0}'.format(address))
+        try:
+            return self.address_map[address]
+        except KeyError:
+            raise ValueError('No register found with address {0}'.format(address))
 
     def write_all(self, force=False):
         '''
         Collect all registers that were changed in software and write to chip
         If force==True, write all software values to chip
         '''
-        indata = self.chip.write_sync(write=False)
+        data = [self.chip.write_sync(write=False)]
+        written = set()
         for reg in self.values():
             if (reg['mode'] != 1 or (not force and not reg.changed)) and 'PIXEL_PORTAL' not in reg['name']:
                 continue
 
-            indata += self[reg['name']].get_write_command()
-            indata += self.chip.write_sync(write=False) * 16
-
-            if len(indata) > 3500:
-                indata += self.chip.write_sync(write=False) * 16
-                self.chip.write_command(indata)
-                indata = self.chip.write_sync(write=False)
+            reg.changed = False
+            if reg['address'] in written:  # all registers at an address are written at once
+                continue
+            written.add(reg['address'])
+            data.append(reg.get_write_command() + self.chip.write_sync(write=False) * 16)
 
-        self.chip.write_command(indata)
+        with self.chip.profiler.phase('register_write', 'chip'):
+            self.chip.write_command(data)  # packed into blocks by write_command
 
     def check_all(self, correct=False):
         ''' Compare all chip registers to software and log result '''
         errors = 0
-        for reg in self.values():
-            if reg['mode'] == 1 and reg['name'] not in ['PIX_PORTAL']:
-                val = reg.read()
-                if val != reg['value']:
-                    errors += 1
-                    if correct:
-                        reg.write()
+        regs = [reg for reg in self.values() if reg['mode'] == 1 and reg['name'] not in ['PIX_PORTAL']]
+        words = self.chip._get_register_values([address for reg in regs for address in reg.get_addresses()])
+        for reg in regs:
+            val = reg._get_from_words(words)
+            if val != reg['value']:
+                errors += 1
+                if correct:
+                    reg.write()
 
         return errors
 
     def update_all(self):
         ''' Set software status to chip registers '''
-        for reg in self.values():
-            if reg['mode'] == 1:
-                reg.read()
+        regs = [reg for reg in self.values() if reg['mode'] == 1]
+        words = self.chip._get_register_values([address for reg in regs for address in reg.get_addresses()])
+        for reg in regs:
+            reg._get_from_words(words)
 
     def reset_all(self):
         ''' Set all chip registers to default values '''
@@ -301,6 +375,8 @@ class MaskObject(dict):
         self.disable_mask = np.ones(self.dimensions, bool)
         self.to_write = np.zeros(self.dimensions, bool)
         self.was = {}
+        # Address of the first column group register per mask, the row group registers follow
+        self.group_registers = {'injection': 82, 'hitor': 18}
 
         for name, props in masks.items():
             self.defaults[name] = props['default']
@@ -312,7 +388,9 @@ class MaskObject(dict):
         # Initialize mask patterns to None and create pattern only on demand to save time
         self.shift_patterns = dict.fromkeys(self.supported_mask_patterns)
 
-        self.mask_cache = []
+        # Command streams of complete mask shifts, keyed by the mask state they start from
+        self.mask_cache = OrderedDict()
+        self.mask_cache_size = 2
 
         super(MaskObject, self).__init__()
 
@@ -336,29 +414,44 @@ class MaskObject(dict):
         self._create_shift_pattern(pattern)
         return self.shift_patterns[pattern]._get_mask_steps() * fe_multiplier
 
+    def _get_cache_key(self, masks, pattern, skip_empty):
+        ''' Hash of everything the command stream of a mask shift depends on '''
+        key = hashlib.sha1(repr((sorted(masks), pattern, skip_empty)).encode())
+        for name in sorted(self):
+            key.update(np.ascontiguousarray(self[name]))
+            key.update(np.ascontiguousarray(self.was[name]))  # first step only writes the difference to the chip state
+        return key.hexdigest()
+
     def shift(self, masks=['enable'], pattern='default', cache=False, skip_empty=True):
         '''
             This function is called from scan loops to loop over 1 FE at a time and
             over the shifting masks as defined by the mask shift pattern
+
+            With cache=True the command streams of all mask steps are stored and replayed
+            if the masks and the chip state are identical in a later call, e.g. for the next
+            scan parameter of a threshold scan. Masks are not updated in software during a replay.
         '''
 
         original_masks = {name: mask for name, mask in self.items()}
-        active_pixels = []
 
         self._create_shift_pattern(pattern)
 
-        # Cache calculation to speed up repeated use
-        if cache and self.mask_cache:
-            for fe, data in self.mask_cache:
-                for d in data:
-                    self.chip.write_command(d)
-                if fe != 'reset':
-                    yield fe, active_pixels
-
-            for name, mask in original_masks.items():
-                self[name] = mask
-            return
+        if cache:
+            key = self._get_cache_key(masks, pattern, skip_empty)
+            if key in self.mask_cache:
+                self.mask_cache.move_to_end(key)
+                for fe, active_pixels, commands, splits in self.mask_cache[key]:
+                    if len(commands) > 0:
+                        with self.chip.profiler.phase('mask_write', 'chip'):
+                            self.chip.write_command(np.split(commands, splits))
+                    if fe != 'reset':
+                        yield fe, active_pixels
+                for name, mask in original_masks.items():
+                    self.was[name][:] = mask[:]
+                return
+            steps = []
 
+        active_pixels = []
         for fe, cols in self.chip.flavor_cols.items():
             fe_mask = np.zeros(self.dimensions, bool)
             fe_mask[cols[0]:cols[-1] + 1, :] = True
@@ -367,7 +460,6 @@ class MaskObject(dict):
                 continue
 
             # data = [self.chip.enable_core_col_clock(range(int(cols[0] / 8), int((cols[-1] - 1) / 8 + 1)), write=True)]   # Enable only one frontend at a time
-            data = []
 
             self.shift_patterns[pattern].reset()
             for pat in self.shift_patterns[pattern]:
@@ -376,22 +468,32 @@ class MaskObject(dict):
                         self[mask] = np.logical_and(np.logical_and(original_masks[mask], pat), fe_mask)
                     if not np.any(self['enable'][:]) and skip_empty:   # Skip empty steps for speedup
                         if cache:
-                            self.mask_cache.append(('skipped', []))
+                            steps.append(('skipped', active_pixels) + self._pack_commands([]))
                         yield 'skipped', active_pixels
                         continue
                 else:  # If CrosstalkShiftPattern is used
                     for name, mask in pat.items():
                         self[name] = np.logical_and(np.logical_and(original_masks[name], mask), fe_mask)
-                data.extend(self.update())
-                if cache:
-                    self.mask_cache.append((fe, data))
-                    data = []
+                data = self.update()
                 active_pixels = np.where(self['enable'][0:self.dimensions[0], 0:self.dimensions[1]])
+                if cache:
+                    steps.append((fe, active_pixels) + self._pack_commands(data))
                 yield fe, active_pixels
 
         for name, mask in original_masks.items():
             self[name] = mask
-        self.mask_cache.append(('reset', self.update()))
+        data = self.update()
+        if cache:
+            steps.append(('reset', None) + self._pack_commands(data))
+            self.mask_cache[key] = steps
+            while len(self.mask_cache) > self.mask_cache_size:
+                self.mask_cache.popitem(last=False)
+
+    def _pack_commands(self, data):
+        ''' Store written command chunks as one contiguous array and the positions to split it '''
+        if len(data) == 0:
+            return np.zeros(0, dtype=np.uint8), []
+        return np.concatenate(data).astype(np.uint8), np.cumsum([len(d) for d in data[:-1]])
 
     def reset_all(self):
         for name, _ in self.items():
@@ -403,41 +505,73 @@ class MaskObject(dict):
 
     def _find_changes(self):
         '''
-            Find out which values have changed in any mask compared to last update()
+            Find out which registers have changed in any mask compared to last update():
+            pix_to_write maps the PIXEL_PORTAL words (colgroup x row), inj_to_write and hor_to_write
+            the column group and row group registers (16 columns / rows each)
         '''
-        self.pix_to_write = np.zeros(self.dimensions, bool)
-        self.inj_to_write = np.zeros(self.dimensions, bool)
-        self.hor_to_write = np.zeros(self.dimensions, bool)
-
+        n_colgroups, n_rows = self.dimensions[0] // 4, self.dimensions[1]
+        self.pix_to_write = np.zeros((n_colgroups, n_rows), bool)
         for name, mask in self.items():
-            if 'injection' in name:
-                self.inj_to_write = np.logical_or(self.inj_to_write, np.not_equal(mask, self.was[name]))
-            elif 'hitor' in name:
-                self.hor_to_write = np.logical_or(self.hor_to_write, np.not_equal(mask, self.was[name]))
+            if name in self.group_registers:
+                continue
+            if mask.dtype == bool:  # XOR of bitmaps packed along rows, reduced to column groups
+                diff = np.packbits(mask, axis=1, bitorder='little') ^ np.packbits(self.was[name], axis=1, bitorder='little')
+                diff = np.bitwise_or.reduce(diff.reshape(n_colgroups, 4, -1), axis=1)
+                self.pix_to_write |= np.unpackbits(diff, axis=1, count=n_rows, bitorder='little').view(bool)
             else:
-                self.pix_to_write = np.logical_or(self.pix_to_write, np.not_equal(mask, self.was[name]))
+                self.pix_to_write |= np.not_equal(mask, self.was[name]).reshape(n_colgroups, 4, n_rows).any(axis=1)
+        self.inj_to_write = self.get_group_data(self['injection']) != self.get_group_data(self.was['injection'])
+        self.hor_to_write = self.get_group_data(self['hitor']) != self.get_group_data(self.was['hitor'])
 
     def get_pixel_data(self, col, row):
-        tdac = str(bin(self['tdac'][col, row]))[2:].zfill(3)
-
-        return '0' + tdac if self['enable'][col, row] else '0000'
+        ''' 4-bit pixel configuration (0 + 3-bit TDAC if enabled, else 0), col and row can be arrays '''
+        return np.where(self['enable'][col, row], self['tdac'][col, row] & 0x7, 0).astype(np.uint16)
 
     def get_pixel_portal_data(self, colgroup, row):
-        return int(
-            '0b'
-            + self.get_pixel_data(colgroup * 4 + 3, row)
-            + self.get_pixel_data(colgroup * 4 + 2, row)
-            + self.get_pixel_data(colgroup * 4 + 1, row)
-            + self.get_pixel_data(colgroup * 4, row), 2
-        )
-
-    def get_column_group_data(self, mask, colgroup):
-        dat = np.logical_or.reduce(self[mask], axis=1)[colgroup * 16: (colgroup + 1) * 16]
-        return np.packbits(dat, bitorder='little').view(np.uint16)[0]
-
-    def get_row_group_data(self, mask, rowgroup):
-        dat = np.logical_or.reduce(self[mask], axis=0)[rowgroup * 16: (rowgroup + 1) * 16]
-        return np.packbits(dat, bitorder='little').view(np.uint16)[0]
+        ''' PIXEL_PORTAL word of the four pixels of a column group (lowest column in lowest bits), colgroup and row can be arrays '''
+        cols = np.asarray(colgroup)[..., np.newaxis] * 4 + np.arange(4)
+        pixels = self.get_pixel_data(cols, np.asarray(row)[..., np.newaxis])
+        return np.bitwise_or.reduce(pixels << np.arange(0, 16, 4, dtype=np.uint16), axis=-1)
+
+    def get_pixel_portal_commands(self, colgroups, rows):
+        ''' Command stream to write the PIXEL_PORTAL of the given column groups and rows
+
+            Returns an uint8 array with one 18 byte record per (colgroup, row):
+            write colgroup and row at the same time, write PIXEL_PORTAL, sync.
+        '''
+        portal = self.chip.registers['PIXEL_PORTAL']
+        portal_data = self.get_pixel_portal_data(colgroups, rows)
+
+        records = np.empty((len(portal_data), 18), dtype=np.uint8)
+        records[:, :8] = self.chip._encode_register_writes(17, (colgroups & 0x7f) << 9 | (rows & 0x1ff))
+        records[:, 8:16] = self.chip._encode_register_writes(portal['address'], portal_data.astype(np.uint32) << portal['offset'])
+        records[:, 16:] = self.chip.write_sync(write=False)
+        if len(portal_data) > 0:
+            portal.set(int(portal_data[-1]))
+        return records
+
+    def _write_records(self, indata, records):
+        ''' Write command records (one per row) after indata, in chunks that fit into the command memory '''
+        records_per_chunk = max(1, (self.chip.get_cmd_mem_size() - len(indata)) // records.shape[1])
+        data = []
+        for start in range(0, len(records), records_per_chunk):
+            data.append(np.concatenate((np.asarray(indata, dtype=np.uint8), records[start:start + records_per_chunk].ravel())))
+            indata = self.chip.write_sync(write=False)
+        self.chip.write_command(data)
+        return data
+
+    def get_group_data(self, mask):
+        ''' Column group words followed by row group words of a mask, bit i of a word is set if column / row 16 * group + i has any pixel set '''
+        packed = np.packbits(mask, axis=1, bitorder='little')  # bitmap of the rows of each column
+        return np.concatenate((np.packbits(packed.any(axis=1), bitorder='little').view(np.uint16),
+                               np.bitwise_or.reduce(packed, axis=0).view(np.uint16)))
+
+    def get_group_commands(self, name, groups):
+        ''' Command stream to write the given group registers of mask name (see get_group_data), one 10 byte record per register '''
+        records = np.empty((len(groups), 10), dtype=np.uint8)
+        records[:, :8] = self.chip._encode_register_writes(self.group_registers[name] + groups, self.get_group_data(self[name])[groups])
+        records[:, 8:] = self.chip.write_sync(write=False)
+        return records
 
     def update(self, force=False):
         ''' Write the actual pixel register configuration
@@ -448,80 +582,23 @@ class MaskObject(dict):
         if force and self.chip.daq.board_version == 'SIMULATION':
             return []
 
-        self._find_changes()
-        if force:
-            inj_write_mask = np.ones(self.dimensions, bool)
-            pix_write_mask = np.ones(self.dimensions, bool)
-            hor_write_mask = np.ones(self.dimensions, bool)
-        else:   # Find out which pixels need to be updated
-            inj_write_mask = self.inj_to_write
-            pix_write_mask = self.pix_to_write
-            hor_write_mask = self.hor_to_write
-        inj_to_write = np.column_stack((np.where(inj_write_mask)))
-        pix_to_write = np.column_stack((np.where(pix_write_mask)))
-        hor_to_write = np.column_stack((np.where(hor_write_mask)))
+        with self.chip.profiler.phase('mask_write', 'chip'):
+            self._find_changes()
+            if force:
+                self.pix_to_write[:] = True
+                self.inj_to_write[:] = True
+                self.hor_to_write[:] = True
 
-        data = []
-        indata = self.chip.write_sync(write=False) * 10
-        if len(pix_to_write) > 0:
-            written = set()
-            for (col, row) in pix_to_write:
-                colgroup = int(col / 4)
-
-                # Speedup
-                if (colgroup, row) in written:
-                    continue
-
-                indata += self.chip._write_register(17, (colgroup & 0x7f) << 9 | (row & 0x1ff), write=False)  # Write colgroup and row at the same time for speedup
-                indata += self.chip.registers["PIXEL_PORTAL"].get_write_command(self.get_pixel_portal_data(colgroup, row))
-                indata += self.chip.write_sync(write=False)
-                written.add((colgroup, row))
-                if len(indata) > 4000:  # Write command to chip before it gets too long
-                    self.chip.write_command(indata)
-                    data.append(indata)
-                    indata = self.chip.write_sync(write=False)
-            self.chip.write_command(indata)
-            data.append(indata)
-        if len(inj_to_write) > 0:
-            written = set()
-            for (col, row) in inj_to_write:
-                colgroup = int(col / 16)
-                rowgroup = int(row / 16)
-
-                # Speedup
-                if (colgroup, rowgroup) in written:
-                    continue
-
-                indata += self.chip._write_register(82 + colgroup, self.get_column_group_data('injection', colgroup))
-                indata += self.chip._write_register(114 + rowgroup, self.get_row_group_data('injection', rowgroup))
-                indata += self.chip.write_sync(write=False)
-                written.add((colgroup, rowgroup))
-                if len(indata) > 4000:  # Write command to chip before it gets too long
-                    self.chip.write_command(indata)
-                    data.append(indata)
-                    indata = self.chip.write_sync(write=False)
-            self.chip.write_command(indata)
-            data.append(indata)
-        if len(hor_to_write) > 0:
-            written = set()
-            for (col, row) in inj_to_write:
-                colgroup = int(col / 16)
-                rowgroup = int(row / 16)
-
-                # Speedup
-                if (colgroup, rowgroup) in written:
-                    continue
-
-                indata += self.chip._write_register(18 + colgroup, self.get_column_group_data('hitor', colgroup))
-                indata += self.chip._write_register(50 + rowgroup, self.get_row_group_data('hitor', rowgroup))
-                indata += self.chip.write_sync(write=False)
-                written.add((colgroup, rowgroup))
-                if len(indata) > 4000:  # Write command to chip before it gets too long
-                    self.chip.write_command(indata)
-                    data.append(indata)
+            data = []
+            indata = self.chip.write_sync(write=False) * 10
+            if np.any(self.pix_to_write):
+                colgroups, rows = np.nonzero(self.pix_to_write)
+                data.extend(self._write_records(indata, self.get_pixel_portal_commands(colgroups, rows)))
+                indata = self.chip.write_sync(write=False)
+            for name, to_write in (('injection', self.inj_to_write), ('hitor', self.hor_to_write)):
+                if np.any(to_write):
+                    data.extend(self._write_records(indata, self.get_group_commands(name, np.nonzero(to_write)[0])))
                     indata = self.chip.write_sync(write=False)
-            self.chip.write_command(indata)
-            data.append(indata)
 
         # Set this mask as last mask to be able to find changes in next update()
         for name, mask in self.items():
@@ -623,6 +700,8 @@ class TJMonoPix2(object):
         31: 0b11010100
     }
 
+    cmd_symbols = np.array(list(cmd_data_map.values()), dtype=np.uint8)  # index = 5-bit value
+
     CMD_SYNC = [0b10000001, 0b01111110]
     CMD_CLEAR = 0b01011010
     CMD_GLOBAL_PULSE = 0b01011100
@@ -674,6 +753,8 @@ class TJMonoPix2(object):
                 self.masks.disable_mask[pix[0], pix[1]] = False
 
         self.debug = 0
+        self._cmd_mem_size = None
+        self.profiler = Profiler()  # disabled, replaced by the profiler of the scan
 
     def get_sn(self):
         return self.chip_sn
@@ -744,6 +825,43 @@ class TJMonoPix2(object):
         self.registers["FREEZE_STOP_CONF"].write(40 + delay + rd_frz_dly)
         self.registers["STOP_CONF"].write(40 + delay + rd_frz_dly)
 
+    def configure_column_readout(self, disabled_columns=(), bcid_disabled_columns=(), verify=True):
+        '''
+            Enable readout (EN_RO_CONF, EN_RO_RST_CONF, EN_FREEZE_CONF) and BCID distribution (EN_BCID_CONF)
+            for all double columns except those containing one of the given columns.
+
+            By default the BCID distribution stays enabled in all double columns, at the cost of a higher
+            I_LV and temperature. bcid_disabled_columns (e.g. the disabled columns) restricts it to the
+            used columns; it must stay enabled in the columns under test, otherwise the ToT is 0.
+
+            The 64 register words are written in one command stream and verified with one batched readback.
+        '''
+        ro_value = self.get_double_column_value(disabled_columns)
+        bcid_value = self.get_double_column_value(bcid_disabled_columns)
+        regs = [self.registers[name] for name in ('EN_RO_CONF', 'EN_BCID_CONF', 'EN_RO_RST_CONF', 'EN_FREEZE_CONF')]
+
+        data = []
+        for reg in regs:
+            reg.set(bcid_value if reg['name'] == 'EN_BCID_CONF' else ro_value)
+            reg.changed = False
+            data.append(reg.get_write_command() + self.write_sync(write=False))
+        with self.profiler.phase('register_write', 'chip'):
+            self.write_command(data)
+        self.log.info('Double column readout enabled: 0x{0:064x}, BCID enabled: 0x{1:064x}'.format(ro_value, bcid_value))
+
+        if verify:
+            words = self._get_register_values([address for reg in regs for address in reg.get_addresses()])
+            for reg in regs:
+                if reg._get_from_words(words) != reg['value']:
+                    raise RuntimeError('Could not verify value of register {0}'.format(reg['name']))
+
+    def get_double_column_value(self, disabled_columns=()):
+        ''' 256-bit double column enable value, a double column is disabled if any of its columns is disabled '''
+        value = (1 << 256) - 1
+        for col in disabled_columns:
+            value &= ~(1 << (col // 2))
+        return value
+
     def reset(self):
         if self.daq.board_version == 'SIMULATION':
             return
@@ -797,91 +915,19 @@ class TJMonoPix2(object):
         return hit
 
     def interpret_no8b10b(self, raw_data):
-        hit_dtype = np.dtype(
-            [("col", "<u2"), ("row", "<u2"), ("le", "<u1"), ("te", "<u1"), ("token_id", "<i8")])
-        r = raw_data[(raw_data & 0xF8000000) == 0x40000000]
-        r0 = (r & 0x7FC0000) >> 18
-        r1 = (r & 0x003FE00) >> 9
-        r2 = (r & 0x00001FF)
-        for i in range(len(r)):
-            print("=====sim=====", i, hex(r0[i]), hex(r1[i]), hex(r2[i]))
-        rx_data = np.reshape(np.vstack((r0, r1, r2)), -1, order="F")
-        hit = np.empty(len(rx_data) // 4 + 10, dtype=hit_dtype)
-        i = 0
-        ii = 0
-        while i < len(rx_data):
-            if rx_data[i] == 0x13C:
-                i = i + 1
-            elif i + 3 < len(rx_data):
-                hit[ii]['col'] = (rx_data[i] << 1) + ((rx_data[i + 2] & 0x2) >> 1)
-                hit[ii]['row'] = ((rx_data[i + 2] & 0x1) << 9) + rx_data[i + 3]
-                hit[ii]['le'] = gray2bin((rx_data[i + 1] >> 1))
-                hit[ii]['te'] = gray2bin(((rx_data[i + 1] & 0x1) << 6) + ((rx_data[i + 2] & 0xFC) >> 2))
-                hit[ii]['token_id'] = 0
-                ii = ii + 1
-                i = i + 4
-            else:
-                print(i, hex(rx_data[i]))
-                i = i + 1
-        return hit[:ii]
+        rx_data = split_tjmono_symbols(raw_data)
+        hit = np.empty(len(rx_data) // 4 + 10, dtype=HIT_DTYPE)
+        return hit[:_interpret_no8b10b(rx_data, hit)]
 
     def interpret_data(self, raw_data):
-        hit_dtype = np.dtype(
-            [("col", "<u2"), ("row", "<u2"), ("le", "<u1"), ("te", "<u1"), ("token_id", "<i8")])
-        reg_dtype = np.dtype([("address", "<u1"), ("value", "<u2")])
-        r = raw_data[(raw_data & 0xF8000000) == 0x40000000]
-        r0 = (r & 0x7FC0000) >> 18
-        r1 = (r & 0x003FE00) >> 9
-        r2 = (r & 0x00001FF)
-        rx_data = np.reshape(np.vstack((r0, r1, r2)), -1, order="F")
-        hit = np.empty(len(rx_data) // 4 + 10, dtype=hit_dtype)
-        reg = np.empty(len(rx_data) // 5 + 10, dtype=reg_dtype)
-        h_i = 0
-        r_i = 0
-        idx = 0
-        token_id = 0
-        flg = 0
-        while idx < len(rx_data):
-            if rx_data[idx] == 0x1fc:
-                if len(rx_data) > idx + 5 and rx_data[idx + 4] == 0x15c:  # reg data
-                    reg[r_i]['address'] = (rx_data[idx + 1] & 0x0FF)
-                    reg[r_i]['value'] = ((rx_data[idx + 2] & 0x0FF) << 8) + (rx_data[idx + 3] & 0x0FF)
-                    r_i = r_i + 1
-                    idx = idx + 5
-                else:
-                    print("interpret_data: broken reg data", idx)
-                    idx = idx + 1
-            elif rx_data[idx] == 0x1bc:  # sof
-                idx = idx + 1
-                if flg != 0:
-                    print("interpret_data: eof is missing")
-                flg = 1
-            elif rx_data[idx] == 0x17c:  # eof
-                if flg != 1:
-                    print("interpret_data: eof before sof", idx, hex(rx_data[idx]))
-                flg = 0
-                idx = idx + 1
-                token_id = token_id + 1
-            elif rx_data[idx] == 0x13c:  # idle (dummy data)
-                idx = idx + 1
-            else:
-                if flg != 1:
-                    print("interpret_data: sof is missing", idx, hex(rx_data[idx]))
-                if len(rx_data) < idx + 4:
-                    print("interpret_data: incomplete data")
-                    break
-                hit[h_i]['token_id'] = token_id
-                hit[h_i]['le'] = (rx_data[idx + 1] & 0xFE) >> 1
-                hit[h_i]['te'] = (rx_data[idx + 1] & 0x01) << 6 | ((rx_data[idx + 2] & 0xFC) >> 2)
-                hit[h_i]['row'] = ((rx_data[idx + 2] & 0x1) << 8) | (rx_data[idx + 3] & 0xFF)
-                hit[h_i]['col'] = ((rx_data[idx] & 0xFF) << 1) + ((rx_data[idx + 2] & 0x2) >> 1)
-                idx = idx + 4
-                h_i = h_i + 1
-        hit = hit[:h_i]
-        reg = reg[:r_i]
-        hit['le'] = gray2bin(np.copy(hit['le']))
-        hit['te'] = gray2bin(np.copy(hit['te']))
-        return hit, reg
+        ''' Decode raw data into hits and register replies (structured arrays) '''
+        rx_data = split_tjmono_symbols(raw_data)
+        hit = np.empty(len(rx_data) // 4 + 10, dtype=HIT_DTYPE)
+        reg = np.empty(len(rx_data) // 5 + 10, dtype=REG_DTYPE)
+        n_hits, n_regs, errors = _interpret_data(rx_data, hit, reg)
+        if errors:
+            self.log.debug('interpret_data: %d decoding errors in %d symbols', errors, len(rx_data))
+        return hit[:n_hits], reg[:n_regs]
 
     def get_temperature(self, n=10):
         # TODO: Why is this needed? Should be handled by basil probably
@@ -902,6 +948,32 @@ class TJMonoPix2(object):
         return np.average(temp[temp != float("nan")])
 
     # COMMAND DECODER
+    def get_cmd_mem_size(self):
+        ''' Size of the command encoder memory in bytes, read once from the DAQ '''
+        if self._cmd_mem_size is None:
+            self._cmd_mem_size = self.daq['cmd'].get_mem_size()
+        return self._cmd_mem_size
+
+    def _wait_for_cmd_done(self, max_interval=0.001):
+        ''' Poll the command encoder until it is done, with an exponential backoff bounded by max_interval '''
+        interval = 1e-5
+        while not self.daq['cmd'].is_done():
+            time.sleep(interval)
+            interval = min(2 * interval, max_interval)
+
+    def _get_command_blocks(self, data):
+        ''' Pack a sequence of commands into blocks of up to get_cmd_mem_size() bytes, split only between commands '''
+        mem_size = self.get_cmd_mem_size()
+        block, block_size = [], 0
+        for indata in data:
+            if block and block_size + len(indata) > mem_size:
+                yield np.concatenate(block).astype(np.uint8).tolist()
+                block, block_size = [], 0
+            block.append(indata)
+            block_size += len(indata)
+        if block:
+            yield np.concatenate(block).astype(np.uint8).tolist()
+
     def write_command(self, data, repetitions=1, wait_for_done=True, wait_for_ready=False):
         '''
             Write data to the command encoder.
@@ -909,7 +981,9 @@ class TJMonoPix2(object):
             Parameters:
             ----------
                 data : list
-                    Up to [get_cmd_size()] bytes
+                    Up to [get_cmd_mem_size()] bytes, or a list of such commands. A list of commands
+                    is packed into as few memory blocks as possible, the next block is prepared
+                    while the previous one is executed.
                 repetitions : integer
                     Sets repetitions of the current request. 1...2^16-1. Default value = 1.
                 wait_for_done : boolean
@@ -917,27 +991,24 @@ class TJMonoPix2(object):
                 wait_for_ready : boolean
                     Wait for completion of preceding commands before sending the command.
         '''
-        if isinstance(data[0], list):
-            for indata in data:
-                self.write_command(indata, repetitions, wait_for_done)
-            return
-
         assert (0 < repetitions < 65536), "Repetition value must be 0<n<2^16"
         if repetitions > 1:
             self.log.debug("Repeating command %i times." % (repetitions))
 
         if wait_for_ready:
-            while (not self.daq['cmd'].is_done()):
-                pass
+            self._wait_for_cmd_done()
 
-        self.daq['cmd'].set_data(data)
-        self.daq['cmd'].set_size(len(data))
-        self.daq['cmd'].set_repetitions(repetitions)
-        self.daq['cmd'].start()
+        blocks = self._get_command_blocks(data) if isinstance(data[0], (list, np.ndarray)) else [data]
+        for i, block in enumerate(blocks):
+            if i > 0:  # the command memory can only be written when the previous block is done
+                self._wait_for_cmd_done()
+            self.daq['cmd'].set_data(block)
+            self.daq['cmd'].set_size(len(block))
+            self.daq['cmd'].set_repetitions(repetitions)
+            self.daq['cmd'].start()
 
         if wait_for_done:
-            while (not self.daq['cmd'].is_done()):
-                pass
+            self._wait_for_cmd_done()
 
     def write_sync(self, write=True):
         indata = [0b10000001, 0b01111110]
@@ -982,6 +1053,35 @@ class TJMonoPix2(object):
 
         return indata
 
+    def _encode_register_writes(self, address, data):
+        '''
+            Vectorized _write_register(address, data, write=False) for many register writes at once
+
+            Parameters:
+            ----------
+                address : int or array of int
+                    Address(es) of the registers to be written to
+                data : int or array of int
+                    Value(s) to write into the registers
+
+            Returns:
+            ----------
+                indata : np.ndarray
+                    uint8 array of shape (n, 8) with one register write command per row.
+        '''
+        address, data = np.broadcast_arrays(np.atleast_1d(address).astype(np.uint32), np.atleast_1d(data).astype(np.uint32))
+
+        indata = np.empty((len(data), 8), dtype=np.uint8)
+        indata[:, 0] = self.CMD_REGISTER
+        indata[:, 1] = self.cmd_data_map[self.chip_id]
+        indata[:, 2] = self.cmd_symbols[address >> 5]
+        indata[:, 3] = self.cmd_symbols[address & 0x1f]
+        indata[:, 4] = self.cmd_symbols[data >> 11]
+        indata[:, 5] = self.cmd_symbols[(data >> 6) & 0x1f]
+        indata[:, 6] = self.cmd_symbols[(data >> 1) & 0x1f]
+        indata[:, 7] = self.cmd_symbols[(data & 0x1) << 4]
+        return indata
+
     def _read_register(self, address, write=True):
         '''
             Sends read command to register with data
@@ -1009,25 +1109,40 @@ class TJMonoPix2(object):
         return indata
 
     def _get_register_value(self, address, timeout=1000, tries=10):
-        for _ in range(tries):
-            self._read_register(address)
-            self.write_command(self.write_sync(write=False) * 10)
+        return self._get_register_values([address], timeout=timeout, tries=tries)[address]
+
+    def _get_register_values(self, addresses, timeout=1000, tries=10):
+        '''
+            Read back many registers at once: the read commands of all addresses are sent in one command
+            stream and the replies are collected from the FIFO and matched by address.
+
+            Returns:
+            ----------
+                values : dict
+                    Address -> 16-bit register value
+        '''
+        with self.profiler.phase('register_read', 'chip'):
+            values = {}
+            missing = list(dict.fromkeys(addresses))
             if self.daq.board_version == 'SIMULATION':
                 timeout = 2
-            for _ in range(timeout):
-                if self.daq['FIFO'].get_FIFO_SIZE() > 0:
-                    data = self.daq['FIFO'].get_data()
-                    # userk_data = analysis_utils.process_userk(anb.interpret_userk_data(data))
-                    _, reg_data = self.interpret_data(data)
-                    if len(reg_data) == 1:
-                        return reg_data[0]['value']
-                    else:
+            for _ in range(tries):
+                self.write_command([self._read_register(address, write=False) + self.write_sync(write=False) * 10 for address in missing])
+                for _ in range(timeout):
+                    if self.daq['FIFO'].get_FIFO_SIZE() > 0:
+                        _, reg_data = self.interpret_data(self.daq['FIFO'].get_data())
+                        for address, value in zip(reg_data['address'].tolist(), reg_data['value'].tolist()):
+                            if address in missing:
+                                values[address] = value
+                        missing = [address for address in missing if address not in values]
+                        if not missing:
+                            return values
                         continue
-                self.write_command(self.write_sync(write=False) * 10)
+                    self.write_command(self.write_sync(write=False) * 10)
+                else:
+                    self.log.warning('Timeout while waiting for register response of %d addresses.', len(missing))
             else:
-                self.log.warning('Timeout while waiting for register response.')
-        else:
-            raise RuntimeError('Timeout while waiting for register response.')
+                raise RuntimeError('Timeout while waiting for register response of addresses {0}.'.format(missing))
 
     def write_cal(self, PulseStartCnfg=1, PulseStopCnfg=10, wait_cycles=0, write=True):
         '''
@@ -1069,7 +1184,8 @@ class TJMonoPix2(object):
         indata += self.write_sync(write=False) * latency
 
         if write:
-            self.write_command(indata, repetitions=repetitions)
+            with self.profiler.phase('injection', 'chip'):
+                self.write_command(indata, repetitions=repetitions)
         return indata
 
 